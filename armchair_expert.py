@@ -1,18 +1,27 @@
 import argparse
 import logging
+import os
 import signal
 import sys
 from enum import Enum, unique
 from multiprocessing import Event
+from itertools import islice
+from typing import Iterable, Iterator, Optional
 
-from common.nlp import create_nlp_instance, SpacyPreprocessor
+from common.nlp import create_nlp_instance, nlp_version, ParsedDoc
 from config.armchair_expert import ARMCHAIR_EXPERT_LOGLEVEL
-from config.ml import USE_GPU, STRUCTURE_MODEL_PATH, MARKOV_DB_PATH, \
-    STRUCTURE_MODEL_TRAINING_EPOCHS, STRUCTURE_MODEL_TRAINING_MAX_SIZE
-from markov_engine import MarkovTrieDb, MarkovTrainer, MarkovFilters
+from config.ml import USE_GPU, STRUCTURE_MODEL_PATH, MARKOV_DB_PATH, MARKOV_JOURNAL_PATH, \
+    STRUCTURE_MODEL_TRAINING_EPOCHS, REACTION_MODEL_PATH, CAPITALIZATION_COMPOUND_RULES, REACTION_RATING_INCREMENT, \
+    NLP_PIPE_BATCH_SIZE, NLP_PIPE_PROCESSES, NLP_PROFILE_TRAINING, NLP_PROFILE_SERVING, MARKOV_TRAINING_BATCH_SIZE, \
+    MARKOV_TRAINING_PROCESSES, MARKOV_ONLINE_LEARNING, MARKOV_ONLINE_LEARNING_INTERVAL, \
+    MARKOV_ONLINE_LEARNING_BATCH_SIZE, STRUCTURE_MODEL_TRAINING_SOURCE_WEIGHTS
+from markov_engine import MarkovTrieDb, MarkovTrainer, MarkovFilters, MarkovLearningPipeline, MarkovJournal
+from models.reaction import AOLReactionModelScheduler, AOLReactionRatingPipeline
 from models.structure import StructureModelScheduler, StructurePreprocessor
 from storage.armchair_expert import InputTextStatManager
+from storage.corpus import CorpusManager
 from storage.imported import ImportTrainingDataManager
+from storage.parse_cache import ParsedDocCacheManager
 
 
 @unique
@@ -27,9 +36,14 @@ class ArmchairExpert(object):
     def __init__(self):
         # Placeholders
         self._markov_model = None
+        self._markov_model_changed = False
+        self._markov_journal = None
         self._nlp = None
+        self._training_nlp = None
         self._status = None
         self._structure_scheduler = None
+        self._reaction_scheduler = None
+        self._learning_pipeline = None
         self._connectors = []
         self._connectors_event = Event()
         self._twitter_connector = None
@@ -49,6 +63,9 @@ class ArmchairExpert(object):
         if not retrain_markov:
             try:
                 self._markov_model.load(MARKOV_DB_PATH)
+                # Whatever was learned and rated since it was last saved in full
+                if MarkovJournal.replay(MARKOV_JOURNAL_PATH, self._markov_model) > 0:
+                    self._markov_model_changed = True
             except FileNotFoundError:
                 pass
 
@@ -63,6 +80,12 @@ class ArmchairExpert(object):
             except FileNotFoundError:
                 structure_model_trained = False
 
+        # Rating with the reaction model is only possible once it has weights
+        if os.path.exists(REACTION_MODEL_PATH):
+            self._reaction_scheduler = AOLReactionModelScheduler(REACTION_MODEL_PATH, USE_GPU)
+            self._reaction_scheduler.start()
+            self._reaction_scheduler.load(REACTION_MODEL_PATH)
+
         # Initialize connectors
         try:
             from config.twitter import TWITTER_CREDENTIALS
@@ -92,11 +115,17 @@ class ArmchairExpert(object):
 
         # Non forking initializations
         self._logger.info("Loading spaCy model")
-        self._nlp = create_nlp_instance()
+        self._nlp = create_nlp_instance(NLP_PROFILE_SERVING)
+        if NLP_PROFILE_TRAINING == NLP_PROFILE_SERVING:
+            self._training_nlp = self._nlp
+        else:
+            self._training_nlp = create_nlp_instance(NLP_PROFILE_TRAINING)
 
         # Catch up on training now that everything is initialized but not yet started
         if retrain_structure or not structure_model_trained:
-            self.train(retrain_structure=True, retrain_markov=retrain_markov)
+            # Without any weights to serve from we have to wait for training to finish
+            self.train(retrain_structure=True, retrain_markov=retrain_markov,
+                       wait_structure=not structure_model_trained)
         else:
             self.train(retrain_structure=False, retrain_markov=retrain_markov)
 
@@ -106,122 +135,121 @@ class ArmchairExpert(object):
             connector.start()
             connector.unmute()
 
+        # The journal picks up from a model saved in full, then keeps what is merged while running on disk.
+        # It and the learning pipeline are threads, which only start once the connector processes have forked
+        if self._markov_model_changed or self._markov_model.checksum is None:
+            self._markov_model.save(MARKOV_DB_PATH)
+            self._markov_model_changed = False
+        self._markov_journal = MarkovJournal(MARKOV_JOURNAL_PATH)
+        self._markov_journal.start()
+        self._markov_journal.reset(self._markov_model.checksum)
+
+        # Learn messages stored from now on in the background, parsing with an nlp instance of its own
+        if MARKOV_ONLINE_LEARNING:
+            if self._training_nlp is not self._nlp:
+                learning_nlp = self._training_nlp
+            else:
+                learning_nlp = create_nlp_instance(NLP_PROFILE_TRAINING)
+            if self._reaction_scheduler is not None:
+                # Also rates what it learns, from the same parse
+                self._learning_pipeline = AOLReactionRatingPipeline(self._reaction_scheduler,
+                                                                    REACTION_RATING_INCREMENT, learning_nlp,
+                                                                    [CorpusManager],
+                                                                    interval=MARKOV_ONLINE_LEARNING_INTERVAL,
+                                                                    batch_size=MARKOV_ONLINE_LEARNING_BATCH_SIZE,
+                                                                    compound_rules=CAPITALIZATION_COMPOUND_RULES,
+                                                                    sync=self._sync_corpus)
+            else:
+                self._learning_pipeline = MarkovLearningPipeline(learning_nlp, [CorpusManager],
+                                                                 interval=MARKOV_ONLINE_LEARNING_INTERVAL,
+                                                                 batch_size=MARKOV_ONLINE_LEARNING_BATCH_SIZE,
+                                                                 compound_rules=CAPITALIZATION_COMPOUND_RULES,
+                                                                 sync=self._sync_corpus)
+            self._learning_pipeline.start()
+
         # Handle events
         self._main()
 
-    def _preprocess_structure_data(self):
-        structure_preprocessor = StructurePreprocessor()
-
-        self._logger.info("Training_Preprocessing_Structure(Import)")
-        imported_messages = ImportTrainingDataManager().all_training_data(limit=STRUCTURE_MODEL_TRAINING_MAX_SIZE,
-                                                                          order_by='id', order='desc')
-        for message_idx, message in enumerate(imported_messages):
-            # Print Progress
-            if message_idx % 100 == 0:
-                self._logger.info(
-                    "Training_Preprocessing_Structure(Import): %f%%" % (
-                            message_idx / min(STRUCTURE_MODEL_TRAINING_MAX_SIZE, len(imported_messages)) * 100))
-
-            doc = self._nlp(MarkovFilters.filter_input(message[0].decode()))
-            if not structure_preprocessor.preprocess(doc):
-                return structure_preprocessor
-
-        tweets = None
+    def _training_sources(self) -> list:
+        # (Name, data manager)
+        sources = [("Import", ImportTrainingDataManager)]
         if self._twitter_connector is not None:
-            self._logger.info("Training_Preprocessing_Structure(Twitter)")
             from storage.twitter import TwitterTrainingDataManager
-
-            tweets = TwitterTrainingDataManager().all_training_data(limit=STRUCTURE_MODEL_TRAINING_MAX_SIZE,
-                                                                    order_by='timestamp', order='desc')
-            for tweet_idx, tweet in enumerate(tweets):
-                # Print Progress
-                if tweet_idx % 100 == 0:
-                    self._logger.info(
-                        "Training_Preprocessing_Structure(Twitter): %f%%" % (
-                                tweet_idx / min(STRUCTURE_MODEL_TRAINING_MAX_SIZE, len(tweets)) * 100))
-
-                doc = self._nlp(MarkovFilters.filter_input(tweet[0].decode()))
-                if not structure_preprocessor.preprocess(doc):
-                    return structure_preprocessor
-
-        discord_messages = None
+            sources.append(("Twitter", TwitterTrainingDataManager))
         if self._discord_connector is not None:
-            self._logger.info("Training_Preprocessing_Structure(Discord)")
             from storage.discord import DiscordTrainingDataManager
-
-            discord_messages = DiscordTrainingDataManager().all_training_data(limit=STRUCTURE_MODEL_TRAINING_MAX_SIZE,
-                                                                              order_by='timestamp', order='desc')
-            for message_idx, message in enumerate(discord_messages):
+            sources.append(("Discord", DiscordTrainingDataManager))
+        return sources
+
+    def _sync_corpus(self):
+        # Training only reads the corpus, every source is copied into it first
+        corpus = CorpusManager()
+        for name, data_manager_type in self._training_sources():
+            data_manager = data_manager_type()
+            synced = corpus.sync(data_manager)
+            data_manager.close()
+            if synced > 0:
+                self._logger.info("Corpus(%s): %d new messages" % (name, synced))
+        corpus.close()
+
+    def _parse_rows(self, rows: Iterable, total: int, name: str, source: str):
+        parse_cache = ParsedDocCacheManager(nlp_version(self._training_nlp, CAPITALIZATION_COMPOUND_RULES))
+
+        doc_idx = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, NLP_PIPE_BATCH_SIZE * NLP_PIPE_PROCESSES))
+            if len(chunk) == 0:
+                break
+
+            # Only parse rows which aren't already in the cache
+            cached = parse_cache.get(source, [row[0] for row in chunk])
+            texts = ((MarkovFilters.filter_input(row[1].decode()), row) for row in chunk if row[0] not in cached)
+
+            # Parse in batches across several processes, docs come back in the same order as the rows.
+            # n_process needs spaCy 2.2.2+, older versions only get it when asked for more than one process
+            pipe_kwargs = {'n_process': NLP_PIPE_PROCESSES} if NLP_PIPE_PROCESSES > 1 else {}
+            parsed = {}
+            for doc, row in self._training_nlp.pipe(texts, as_tuples=True, batch_size=NLP_PIPE_BATCH_SIZE,
+                                                    **pipe_kwargs):
+                parsed_doc = ParsedDoc.from_doc(doc, CAPITALIZATION_COMPOUND_RULES)
+                parse_cache.add(source, row[0], parsed_doc.to_bytes())
+                parsed[row[0]] = parsed_doc
+            parse_cache.commit()
+
+            for row in chunk:
                 # Print Progress
-                if message_idx % 100 == 0:
-                    self._logger.info(
-                        "Training_Preprocessing_Structure(Discord): %f%%" % (
-                                message_idx / min(STRUCTURE_MODEL_TRAINING_MAX_SIZE, len(discord_messages)) * 100))
-
-                doc = self._nlp(MarkovFilters.filter_input(message[0].decode()))
-                if not structure_preprocessor.preprocess(doc):
-                    return structure_preprocessor
-
-        return structure_preprocessor
-
-    def _preprocess_markov_data(self, all_training_data: bool = False):
-        spacy_preprocessor = SpacyPreprocessor()
-
-        self._logger.info("Training_Preprocessing_Markov(Import)")
-        if not all_training_data:
-            imported_messages = ImportTrainingDataManager().new_training_data()
+                if doc_idx % 100 == 0:
+                    self._logger.info("%s: %f%%" % (name, doc_idx / total * 100))
+                doc_idx += 1
+
+                if row[0] in parsed:
+                    yield parsed[row[0]], row
+                else:
+                    yield ParsedDoc.from_bytes(cached[row[0]]), row
+
+    def _training_docs(self, structure_preprocessor: Optional[StructurePreprocessor], until: int,
+                       retrain_markov: bool = False) -> Iterator[ParsedDoc]:
+        # Every row is read and parsed once, yielding the docs the Markov model should learn from
+        # and feeding the structure preprocessor along the way
+        self._logger.info("Training_Preprocessing")
+        corpus = CorpusManager()
+
+        if structure_preprocessor is not None:
+            # The structure model samples from everything, in a single pass in storage order
+            rows = corpus.training_rows(until=until)
+            total = corpus.count_training_rows(until=until)
         else:
-            imported_messages = ImportTrainingDataManager().all_training_data()
-        for message_idx, message in enumerate(imported_messages):
-            # Print Progress
-            if message_idx % 100 == 0:
-                self._logger.info(
-                    "Training_Preprocessing_Markov(Import): %f%%" % (message_idx / len(imported_messages) * 100))
-
-            doc = self._nlp(MarkovFilters.filter_input(message[0].decode()))
-            spacy_preprocessor.preprocess(doc)
-
-        tweets = None
-        if self._twitter_connector is not None:
-            self._logger.info("Training_Preprocessing_Markov(Twitter)")
-            from storage.twitter import TwitterTrainingDataManager
+            rows = corpus.training_rows(new_only=not retrain_markov, until=until)
+            total = corpus.count_training_rows(new_only=not retrain_markov, until=until)
 
-            if not all_training_data:
-                tweets = TwitterTrainingDataManager().new_training_data()
-            else:
-                tweets = TwitterTrainingDataManager().all_training_data()
-            for tweet_idx, tweet in enumerate(tweets):
-                # Print Progress
-                if tweet_idx % 100 == 0:
-                    self._logger.info("Training_Preprocessing_Markov(Twitter): %f%%" % (tweet_idx / len(tweets) * 100))
+        for doc, row in self._parse_rows(rows, total, "Training_Preprocessing", source=corpus.source):
+            if structure_preprocessor is not None:
+                structure_preprocessor.preprocess(doc, weight=STRUCTURE_MODEL_TRAINING_SOURCE_WEIGHTS.get(row[3], 1.))
+            if retrain_markov or not row[2]:
+                yield doc
 
-                doc = self._nlp(MarkovFilters.filter_input(tweet[0].decode()))
-                spacy_preprocessor.preprocess(doc)
-
-        discord_messages = None
-        if self._discord_connector is not None:
-            self._logger.info("Training_Preprocessing_Markov(Discord)")
-            from storage.discord import DiscordTrainingDataManager
-
-            if not all_training_data:
-                discord_messages = DiscordTrainingDataManager().new_training_data()
-            else:
-                discord_messages = DiscordTrainingDataManager().all_training_data()
-
-            for message_idx, message in enumerate(discord_messages):
-                # Print Progress
-                if message_idx % 100 == 0:
-                    self._logger.info(
-                        "Training_Preprocessing_Markov(Discord): %f%%" % (message_idx / len(discord_messages) * 100))
-
-                doc = self._nlp(MarkovFilters.filter_input(message[0].decode()))
-                spacy_preprocessor.preprocess(doc)
-
-        return spacy_preprocessor
-
-    def _train_markov(self, retrain: bool = False):
-
-        spacy_preprocessor = self._preprocess_markov_data(all_training_data=retrain)
+    def _train_markov(self, docs: Iterable[ParsedDoc], retrain: bool = False):
 
         self._logger.info("Training(Markov)")
         input_text_stats_manager = InputTextStatManager()
@@ -229,51 +257,57 @@ class ArmchairExpert(object):
             # Reset stats if we are retraining
             input_text_stats_manager.reset()
 
+        learned = 0
+
+        def batches():
+            nonlocal learned
+            docs_iter = iter(docs)
+            while True:
+                batch = list(islice(docs_iter, MARKOV_TRAINING_BATCH_SIZE))
+                if len(batch) == 0:
+                    break
+                for doc in batch:
+                    input_text_stats_manager.log_length(length=len(doc.sents))
+                learned += len(batch)
+                self._logger.info("Training(Markov): %d documents" % learned)
+                yield batch
+
+        # Batches are learned and discarded as they are parsed, so memory doesn't grow with the corpus
         markov_trainer = MarkovTrainer(self._markov_model)
-        docs, _ = spacy_preprocessor.get_preprocessed_data()
-        for doc_idx, doc in enumerate(docs):
-            # Print Progress
-            if doc_idx % 100 == 0:
-                self._logger.info("Training(Markov): %f%%" % (doc_idx / len(docs) * 100))
-
-            markov_trainer.learn(doc)
-
-            sents = 0
-            for sent in doc.sents:
-                sents += 1
-            input_text_stats_manager.log_length(length=sents)
+        if MARKOV_TRAINING_PROCESSES > 1:
+            markov_trainer.learn_parallel(batches(), MARKOV_TRAINING_PROCESSES)
+        else:
+            for batch in batches():
+                markov_trainer.learn_batch(batch)
 
-        if len(docs) > 0:
+        if learned > 0:
             self._markov_model.save(MARKOV_DB_PATH)
             input_text_stats_manager.commit()
 
-    def _train_structure(self, retrain: bool = False):
-
-        if not retrain:
-            return
-
-        structure_preprocessor = self._preprocess_structure_data()
+    def _train_structure(self, structure_preprocessor: StructurePreprocessor, wait: bool = False):
 
         self._logger.info("Training(Structure)")
         structure_data, structure_labels = structure_preprocessor.get_preprocessed_data()
         if len(structure_data) > 0:
-            self._structure_scheduler.train(structure_data, structure_labels, epochs=STRUCTURE_MODEL_TRAINING_EPOCHS)
-            self._structure_scheduler.save(STRUCTURE_MODEL_PATH)
+            # Runs in the background, the new weights are hot loaded once training finishes
+            self._structure_scheduler.train(structure_data, structure_labels, path=STRUCTURE_MODEL_PATH,
+                                            epochs=STRUCTURE_MODEL_TRAINING_EPOCHS, wait=wait)
 
-    def train(self, retrain_structure: bool = False, retrain_markov: bool = False):
+    def train(self, retrain_structure: bool = False, retrain_markov: bool = False, wait_structure: bool = False):
 
         self._logger.info("Training begin")
-        self._train_markov(retrain_markov)
-        self._train_structure(retrain_structure)
+        self._sync_corpus()
+        # Only train on what has been stored so far, anything arriving while training is left for later
+        until = CorpusManager().latest_row_id()
+
+        structure_preprocessor = StructurePreprocessor() if retrain_structure else None
+        self._train_markov(self._training_docs(structure_preprocessor, until, retrain_markov=retrain_markov),
+                           retrain_markov)
+        if retrain_structure:
+            self._train_structure(structure_preprocessor, wait=wait_structure)
 
         # Mark data as trained
-        if self._twitter_connector is not None:
-            from storage.twitter import TwitterTrainingDataManager
-            TwitterTrainingDataManager().mark_trained()
-        if self._discord_connector is not None:
-            from storage.discord import DiscordTrainingDataManager
-            DiscordTrainingDataManager().mark_trained()
-        ImportTrainingDataManager().mark_trained()
+        CorpusManager().mark_trained(until)
 
         self._logger.info("Training end")
 
@@ -295,11 +329,44 @@ class ArmchairExpert(object):
                     else:
                         connector.send(None)
 
+            self._apply_learned()
+
             if self._status == AEStatus.SHUTTING_DOWN:
                 self.shutdown()
                 self._set_status(AEStatus.SHUTDOWN)
                 sys.exit(0)
 
+    def _apply_learned(self):
+        if self._learning_pipeline is None:
+            return
+
+        learned = self._learning_pipeline.results()
+        if len(learned) == 0:
+            return
+
+        markov_trainer = MarkovTrainer(self._markov_model)
+        input_text_stats_manager = InputTextStatManager()
+        for table, sentence_counts, ratings, row_ids in learned:
+            markov_trainer.merge(table)
+            self._markov_journal.learned(table, row_ids)
+            # After the table, so words first seen in this batch can be rated too
+            if ratings is not None:
+                markov_trainer.apply_ratings(ratings)
+                self._markov_journal.rated(ratings)
+            for sentence_count in sentence_counts:
+                input_text_stats_manager.log_length(length=sentence_count)
+        input_text_stats_manager.commit()
+        self._markov_model_changed = True
+
+    def _save_markov_model(self):
+        # Fold the journal into a full save, rows it marked trained are in the model either way
+        self._markov_journal.flush()
+        if self._markov_model_changed:
+            self._markov_model.save(MARKOV_DB_PATH)
+            self._markov_model_changed = False
+            self._markov_journal.reset(self._markov_model.checksum)
+        self._markov_journal.shutdown()
+
     def shutdown(self):
 
         # Shutdown connectors
@@ -307,8 +374,16 @@ class ArmchairExpert(object):
             connector.shutdown()
 
         # Shutdown models
+        if self._learning_pipeline is not None:
+            self._learning_pipeline.shutdown()
+            self._apply_learned()
+        if self._reaction_scheduler is not None:
+            self._reaction_scheduler.shutdown()
         self._structure_scheduler.shutdown()
 
+        # Ratings and new messages are applied while running, persist them
+        self._save_markov_model()
+
     def handle_shutdown(self):
         # Shutdown main()
         self._set_status(AEStatus.SHUTTING_DOWN)
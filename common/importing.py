@@ -0,0 +1,81 @@
+import codecs
+import datetime
+import gzip
+import io
+import re
+from typing import Optional
+
+# Epoch seconds this large are over 3000 years out, so they must be milliseconds
+MILLISECONDS_THRESHOLD = 1e11
+
+# Bytes checked at a time by find_decode_error
+DECODE_CHECK_BLOCK_SIZE = 1 << 20
+
+# Date and time, fractional seconds which are ignored, then an optional UTC offset
+ISO_TIMESTAMP = re.compile(r'(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(?:[.,]\d+)?\s*(Z|[+-]\d{2}:?\d{2})?',
+                           re.IGNORECASE)
+
+
+def open_import_file(path: str, errors: str = 'strict'):
+    # Text in UTF-8, optionally gzip compressed (.gz). Line endings are left alone, the csv module needs them
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors=errors, newline='')
+    return io.open(path, 'r', encoding='utf-8', errors=errors, newline='')
+
+
+def find_decode_error(path: str) -> Optional[int]:
+    # Line number of the first line which isn't valid UTF-8, so a strict import can refuse before storing anything
+    datafile = gzip.open(path, 'rb') if path.endswith('.gz') else io.open(path, 'rb')
+    with datafile:
+        line = 1
+        pending = b''
+        while True:
+            block = datafile.read(DECODE_CHECK_BLOCK_SIZE)
+            data = pending + block
+            try:
+                # A character split across blocks is left pending until the next one
+                _, consumed = codecs.utf_8_decode(data, 'strict', len(block) == 0)
+            except UnicodeDecodeError as e:
+                return line + data.count(b'\n', 0, e.start)
+            if len(block) == 0:
+                return None
+            line += data.count(b'\n', 0, consumed)
+            pending = data[consumed:]
+
+
+def parse_timestamp(value) -> Optional[datetime.datetime]:
+    # Naive UTC, the same as the timestamps the connectors store
+    if value is None or value == '':
+        return None
+
+    # Unix epoch seconds, or milliseconds past what seconds could reasonably be
+    try:
+        seconds = float(value)
+        if abs(seconds) > MILLISECONDS_THRESHOLD:
+            seconds /= 1000
+        return datetime.datetime.utcfromtimestamp(seconds)
+    except (TypeError, ValueError, OverflowError, OSError):
+        pass
+
+    # ISO 8601, times without an offset are taken to be UTC already
+    match = ISO_TIMESTAMP.match(str(value).strip())
+    if match is not None:
+        try:
+            timestamp = datetime.datetime.strptime(match.group(1) + 'T' + match.group(2), '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            return None
+        offset = match.group(3)
+        if offset is not None and offset.upper() != 'Z':
+            digits = offset[1:].replace(':', '')
+            delta = datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))
+            try:
+                timestamp = timestamp - delta if offset[0] == '+' else timestamp + delta
+            except OverflowError:
+                return None
+        return timestamp
+
+    # Just the date
+    try:
+        return datetime.datetime.strptime(str(value).strip()[:10], '%Y-%m-%d')
+    except ValueError:
+        return None
@@ -1,39 +1,76 @@
 from typing import Optional, List, Tuple
 from enum import Enum, unique
-from common.ml import one_hot, MLDataPreprocessor
+from common.ml import one_hot
+import json
 import re
+import numpy as np
 from spacy.tokens import Token, Doc
 
+# Bump whenever the way we derive token features changes, invalidating cached parses
+PARSED_DOC_VERSION = 2
 
-def create_nlp_instance():
+URL_REGEX = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+# Our PoS for a token, filled in by the pipeline so it only has to be worked out once
+if not Token.has_extension('custom_pos'):
+    Token.set_extension('custom_pos', default=None)
+
+
+@unique
+class NlpProfile(Enum):
+    # Everything the spaCy model ships with
+    FULL = 1
+    # Named entities are never used
+    TAGGER_PARSER = 2
+    # Rule based sentence boundaries instead of the dependency parser
+    TAGGER_SENTENCIZER = 3
+
+
+def create_nlp_instance(profile: NlpProfile = NlpProfile.FULL):
     import spacy
     from spacymoji import Emoji
 
-    nlp = spacy.load('en')
+    if profile == NlpProfile.FULL:
+        nlp = spacy.load('en')
+    elif profile == NlpProfile.TAGGER_PARSER:
+        nlp = spacy.load('en', disable=['ner'])
+    else:
+        nlp = spacy.load('en', disable=['parser', 'ner'])
+        nlp.add_pipe(nlp.create_pipe('sentencizer'), first=True)
+
     emoji_pipe = Emoji(nlp)
     nlp.add_pipe(emoji_pipe, first=True)
 
-    # Merge hashtag tokens which were split by spacy
+    # Merge hashtag tokens which were split by spacy and work out our PoS for every token, in a single pass
     def hashtag_pipe(doc):
-        merged_hashtag = False
-        while True:
-            for token_index, token in enumerate(doc):
-                if token.text == '#':
-                    if token.head is not None:
-                        start_index = token.idx
-                        end_index = start_index + len(token.head.text) + 1
-                        if doc.merge(start_index, end_index) is not None:
-                            merged_hashtag = True
-                            break
-            if not merged_hashtag:
-                break
-            merged_hashtag = False
+        hashtags = []
+        for token in doc:
+            # Only merge with the word directly following the '#', this doesn't need the parser
+            if token.text == '#' and token.whitespace_ == '' and token.i + 1 < len(doc):
+                following = doc[token.i + 1]
+                if not following.is_punct and not following.is_space:
+                    hashtags.append(doc[token.i:token.i + 2])
+
+        if len(hashtags) > 0:
+            with doc.retokenize() as retokenizer:
+                for hashtag in hashtags:
+                    retokenizer.merge(hashtag)
+
+        for token in doc:
+            token._.custom_pos = Pos.analyze(token).value
+
         return doc
 
     nlp.add_pipe(hashtag_pipe)
     return nlp
 
 
+def nlp_version(nlp, compound_rules: List[str]) -> str:
+    import spacy
+    return "%d;%s;%s;%s;%s" % (PARSED_DOC_VERSION, spacy.__version__, nlp.meta.get('version'),
+                               ",".join(nlp.pipe_names), ",".join(compound_rules))
+
+
 @unique
 class Pos(Enum):
     NONE = 0
@@ -72,6 +109,12 @@ class Pos(Enum):
 
     @staticmethod
     def from_token(token: Token, people: list = None) -> Optional['Pos']:
+        if people is None and token._.custom_pos is not None:
+            return Pos(token._.custom_pos)
+        return Pos.analyze(token, people)
+
+    @staticmethod
+    def analyze(token: Token, people: list = None) -> Optional['Pos']:
         if token.text[0] == '#':
             return Pos.HASHTAG
         elif token.text[0] == '@':
@@ -87,7 +130,7 @@ class Pos(Enum):
             if token.text in people:
                 return Pos.PROPN
 
-        if re.match(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', token.text):
+        if URL_REGEX.match(token.text):
             return Pos.URL
 
         try:
@@ -118,10 +161,12 @@ class CapitalizationMode(Enum):
         return ret_list
 
     @staticmethod
-    def from_token(token: Token, compound_rules: Optional[List[str]] = None) -> 'CapitalizationMode':
+    def from_token(token: Token, compound_rules: Optional[List[str]] = None,
+                   pos: Optional[Pos] = None) -> 'CapitalizationMode':
 
         # Try to make a guess for many common patterns
-        pos = Pos.from_token(token)
+        if pos is None:
+            pos = Pos.from_token(token)
         if pos in [Pos.NUM, Pos.EMOJI, Pos.SYM, Pos.SPACE, Pos.EOS, Pos.HASHTAG, Pos.PUNCT, Pos.URL]:
             return CapitalizationMode.COMPOUND
 
@@ -185,13 +230,56 @@ class CapitalizationMode(Enum):
         return ret_word
 
 
-class SpacyPreprocessor(MLDataPreprocessor):
-    def __init__(self):
-        MLDataPreprocessor.__init__(self, 'SpacyPreprocessor')
+class ParsedToken(object):
+    def __init__(self, text: str, pos: Pos, mode: CapitalizationMode):
+        self.text = text
+        self.pos = pos
+        self.mode = mode
+
+    def __repr__(self):
+        return self.text
+
+
+class ParsedDoc(object):
+    # Only the token features we train on, cheap to store and load compared to a full parse
+    def __init__(self, sents: List[List[ParsedToken]]):
+        self.sents = sents
+        self._arrays = None
 
-    def preprocess(self, doc: Doc) -> bool:
-        self.data.append(doc)
-        return True
+    def __iter__(self):
+        for sentence in self.sents:
+            for token in sentence:
+                yield token
 
-    def get_preprocessed_data(self) -> Tuple[List, List]:
-        return self.data, self.labels
+    def __len__(self):
+        return sum([len(sentence) for sentence in self.sents])
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Pos values, CapitalizationMode values and sentence lengths, built once per doc
+        if self._arrays is None:
+            tokens = list(self)
+            self._arrays = (np.array([token.pos.value for token in tokens], dtype=np.int32),
+                            np.array([token.mode.value for token in tokens], dtype=np.int32),
+                            np.array([len(sentence) for sentence in self.sents], dtype=np.int32))
+        return self._arrays
+
+    @staticmethod
+    def from_doc(doc: Doc, compound_rules: List[str]) -> 'ParsedDoc':
+        sents = []
+        for sentence in doc.sents:
+            parsed_sentence = []
+            for token in sentence:
+                pos = Pos.from_token(token)
+                mode = CapitalizationMode.from_token(token, compound_rules, pos=pos)
+                parsed_sentence.append(ParsedToken(token.text, pos, mode))
+            sents.append(parsed_sentence)
+        return ParsedDoc(sents)
+
+    def to_bytes(self) -> bytes:
+        return json.dumps([[[token.text, token.pos.value, token.mode.value] for token in sentence]
+                           for sentence in self.sents], separators=(',', ':')).encode()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'ParsedDoc':
+        return ParsedDoc([[ParsedToken(text, Pos(pos), CapitalizationMode(mode)) for text, pos, mode in sentence]
+                          for sentence in json.loads(data.decode())])
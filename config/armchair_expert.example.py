@@ -14,3 +14,18 @@ IMPORT_TRAINING_DB_PATH = 'db/import.db'
 
 # Store statistics here
 STATISTICS_DB_PATH = 'db/statistics.db'
+
+# Cache parsed training data here
+PARSE_CACHE_DB_PATH = 'db/parsecache.db'
+
+# Training data from every source above is consolidated here
+CORPUS_DB_PATH = 'db/corpus.db'
+
+# SQLite settings for every database above. They are opened in WAL mode so connector processes can write
+# while training reads
+# Durability of each commit, NORMAL only risks the last commits on power loss in WAL mode
+STORAGE_SQLITE_SYNCHRONOUS = 'NORMAL'
+# Page cache of each connection in KiB
+STORAGE_SQLITE_CACHE_SIZE = 16384
+# Seconds to wait for another writer before giving up
+STORAGE_SQLITE_BUSY_TIMEOUT = 30
@@ -32,3 +32,9 @@ DISCORD_REMOVE_URL = True
 
 # Store training data here
 DISCORD_TRAINING_DB_PATH = 'db/discord.db'
+
+# Incoming messages are written to the training database in batches by a background thread
+# Write once this many messages are waiting
+DISCORD_STORE_BATCH_SIZE = 100
+# Or at least this often (seconds)
+DISCORD_STORE_FLUSH_INTERVAL = 5
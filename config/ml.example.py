@@ -1,4 +1,4 @@
-from common.nlp import Pos
+from common.nlp import Pos, NlpProfile
 
 # --- "User" Stuff Section ---
 # ----------------------------
@@ -10,6 +10,8 @@ USE_GPU = True
 
 # Paths
 MARKOV_DB_PATH = 'weights/markov.json.zlib'
+# What was learned and rated since the Markov model was last saved in full
+MARKOV_JOURNAL_PATH = 'weights/markov.journal'
 REACTION_MODEL_PATH = "weights/aol-reaction-model.h5"
 STRUCTURE_MODEL_PATH = "weights/structure-model.h5"
 
@@ -25,6 +27,18 @@ MARKOV_GENERATION_WEIGHT_RATING = 10
 # bi-gram window function size
 MARKOV_WINDOW_SIZE = 4
 
+# Number of documents whose bi-grams are aggregated before being merged into the model
+MARKOV_TRAINING_BATCH_SIZE = 10000
+
+# Build the bi-gram tables of several batches at once in worker processes
+MARKOV_TRAINING_PROCESSES = 1
+
+# Learn new messages while running, checking for them every MARKOV_ONLINE_LEARNING_INTERVAL seconds
+# This loads a second spaCy model unless the training and serving profiles differ
+MARKOV_ONLINE_LEARNING = True
+MARKOV_ONLINE_LEARNING_INTERVAL = 5
+MARKOV_ONLINE_LEARNING_BATCH_SIZE = 100
+
 # Chance whether to use a weighted random or argmax when selecting a word
 # These should add up to 1.0
 MARKOV_WORD_CHOICE_WEIGHTED_RANDOM_P_VALUE = 0.75
@@ -35,5 +49,26 @@ CAPITALIZATION_COMPOUND_RULES = ['RT']
 
 # Maximum number of sequences to train the structure model on
 STRUCTURE_MODEL_TRAINING_MAX_SIZE = 250000
+# The sequences are sampled from all training data, favouring sources by weight. 0 leaves a source out and sources
+# not listed here weigh 1. Sources: 'importedmessage', 'tweet', 'discordmessage'
+STRUCTURE_MODEL_TRAINING_SOURCE_WEIGHTS = {'importedmessage': 1., 'tweet': 1., 'discordmessage': 1.}
 STRUCTURE_MODEL_TRAINING_EPOCHS = 10
 STRUCTURE_MODEL_TRAINING_BATCH_SIZE = 128
+
+# Concurrent structure predictions arriving within this window (in seconds) are run together as one batch
+STRUCTURE_MODEL_PREDICT_BATCH_WINDOW = 0.005
+STRUCTURE_MODEL_PREDICT_BATCH_SIZE = 16
+
+# Rate the words of newly learned messages which the reaction model finds funny, by this much per bi-gram
+# Rating happens as part of online learning, see MARKOV_ONLINE_LEARNING
+REACTION_RATING_INCREMENT = 1
+
+# Training text is parsed by spaCy in batches of this size, spread over this many processes
+# (more than one process requires spaCy 2.2.2+)
+NLP_PIPE_BATCH_SIZE = 1000
+NLP_PIPE_PROCESSES = 1
+
+# spaCy pipeline used for training and for replying, see scripts/benchmark_nlp.py to compare them
+# NlpProfile.TAGGER_SENTENCIZER is much faster but finds sentence boundaries by rules instead of the parser
+NLP_PROFILE_TRAINING = NlpProfile.TAGGER_PARSER
+NLP_PROFILE_SERVING = NlpProfile.TAGGER_PARSER
@@ -34,12 +34,9 @@ class ConnectorReplyGenerator(object):
             return None
 
         def structure_generator():
-            sentence_stats_manager = InputTextStatManager()
             while True:
-                choices, p_values = sentence_stats_manager.probabilities()
-                if len(choices) > 0:
-                    num_sentences = np.random.choice(choices, p=p_values)
-                else:
+                num_sentences = InputTextStatManager.sample_length()
+                if num_sentences is None:
                     num_sentences = np.random.randint(1, 5)
                 yield self._structure_scheduler.predict(num_sentences=num_sentences)
 
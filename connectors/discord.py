@@ -5,7 +5,7 @@ import discord
 import logging
 from config.discord import *
 from connectors.connector_common import *
-from storage.discord import DiscordTrainingDataManager
+from storage.discord import DiscordMessageWriter
 from common.discord import DiscordHelper
 from spacy.tokens import Doc
 
@@ -29,9 +29,10 @@ class DiscordReplyGenerator(ConnectorReplyGenerator):
 
 
 class DiscordClient(discord.Client):
-    def __init__(self, worker: 'DiscordWorker'):
+    def __init__(self, worker: 'DiscordWorker', writer: DiscordMessageWriter):
         discord.Client.__init__(self)
         self._worker = worker
+        self._writer = writer
         self._ready = False
         self._logger = logging.getLogger(self.__class__.__name__)
 
@@ -50,14 +51,14 @@ class DiscordClient(discord.Client):
 
         # Learn from private messages
         if message.server is None and DISCORD_LEARN_FROM_DIRECT_MESSAGE:
-            DiscordTrainingDataManager().store(message)
+            self._writer.store(message)
         # Learn from all server messages
         elif message.server is not None and DISCORD_LEARN_FROM_ALL:
             if str(message.channel) not in DISCORD_LEARN_CHANNEL_EXCEPTIONS:
-                DiscordTrainingDataManager().store(message)
+                self._writer.store(message)
         # Learn from User
         elif str(message.author) == DISCORD_LEARN_FROM_USER:
-            DiscordTrainingDataManager().store(message)
+            self._writer.store(message)
 
         # Reply to mentions
         for mention in message.mentions:
@@ -88,6 +89,7 @@ class DiscordWorker(ConnectorWorker):
                                  shutdown_event=shutdown_event)
         self._credentials = credentials
         self._client = None
+        self._writer = None
         self._logger = None
 
     async def _watchdog(self):
@@ -100,12 +102,16 @@ class DiscordWorker(ConnectorWorker):
                 return
 
     def run(self):
-        from storage.discord import DiscordTrainingDataManager
         self._logger = logging.getLogger(self.__class__.__name__)
-        self._db = DiscordTrainingDataManager()
-        self._client = DiscordClient(self)
+        self._writer = DiscordMessageWriter()
+        self._writer.start()
+        self._client = DiscordClient(self, self._writer)
         self._client.loop.create_task(self._watchdog())
-        self._client.run(self._credentials.token)
+        try:
+            self._client.run(self._credentials.token)
+        finally:
+            # Flush whatever is still buffered
+            self._writer.shutdown()
 
 
 class DiscordScheduler(ConnectorScheduler):
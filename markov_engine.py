@@ -1,19 +1,26 @@
 import json
+import logging
+import os
 import random
 import re
 import time
 import zlib
+from collections import deque
 from enum import unique, Enum
-from typing import Optional, List
+from operator import add
+from queue import Queue as ThreadQueue
+from threading import Thread
+from typing import Optional, List, Iterable, Tuple, Callable
 
 import numpy as np
-from spacy.tokens import Doc, Span, Token
+from spacy.tokens import Span
 
 from config.ml import MARKOV_WINDOW_SIZE, MARKOV_GENERATION_WEIGHT_COUNT, MARKOV_GENERATION_WEIGHT_RATING, \
     MARKOV_GENERATE_SUBJECT_POS_PRIORITY, MARKOV_GENERATE_SUBJECT_MAX, MARKOV_WORD_CHOICE_WEIGHTED_RANDOM_P_VALUE, \
-    MARKOV_WORD_CHOICE_ARGMAX_P_VALUE, CAPITALIZATION_COMPOUND_RULES
+    MARKOV_WORD_CHOICE_ARGMAX_P_VALUE
 from common.ml import one_hot
-from common.nlp import Pos, CapitalizationMode
+from common.nlp import Pos, CapitalizationMode, ParsedDoc, ParsedToken
+from storage.storage_common import TrainingDataPipeline
 
 
 class WordKey(object):
@@ -50,14 +57,14 @@ class MarkovNeighbor(object):
         return self.text
 
     @staticmethod
-    def from_token(token: Token) -> 'MarkovNeighbor':
+    def from_token(token: ParsedToken) -> 'MarkovNeighbor':
         key = token.text.lower()
         text = token.text
-        if CapitalizationMode.from_token(token, CAPITALIZATION_COMPOUND_RULES) == CapitalizationMode.COMPOUND:
+        if token.mode == CapitalizationMode.COMPOUND:
             compound = True
         else:
             compound = False
-        pos = Pos.from_token(token)
+        pos = token.pos
         values = [0, 0]
         dist = [0] * (MARKOV_WINDOW_SIZE * 2 + 1)
         return MarkovNeighbor(key, text, pos, compound, values, dist)
@@ -169,12 +176,12 @@ class MarkovWord(object):
         return word
 
     @staticmethod
-    def from_token(token: Token) -> 'MarkovWord':
-        if CapitalizationMode.from_token(token, CAPITALIZATION_COMPOUND_RULES) == CapitalizationMode.COMPOUND:
+    def from_token(token: ParsedToken) -> 'MarkovWord':
+        if token.mode == CapitalizationMode.COMPOUND:
             compound = True
         else:
             compound = False
-        return MarkovWord(token.text, Pos.from_token(token), compound=compound, neighbors={})
+        return MarkovWord(token.text, token.pos, compound=compound, neighbors={})
 
     def get_neighbor(self, key: str) -> Optional[MarkovNeighbor]:
         if key in self.neighbors:
@@ -255,16 +262,27 @@ class MarkovTrieDb(object):
     def __init__(self, path: str = None):
         np.random.seed(int(time.time()))
         self._trie = {}
+        # Of the file last loaded or saved, see MarkovJournal
+        self.checksum = None
         if path is not None:
             self.load(path)
 
     def load(self, path: str):
-        data = zlib.decompress(open(path, 'rb').read()).decode()
-        self._trie = json.loads(data)
+        data = open(path, 'rb').read()
+        self._trie = json.loads(zlib.decompress(data).decode())
+        self.checksum = zlib.crc32(data)
 
     def save(self, path: str):
         data = zlib.compress(json.dumps(self._trie, separators=(',', ':')).encode())
-        open(path, 'wb').write(data)
+
+        # Swapped in whole, so a crash while saving leaves the previous file intact
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        self.checksum = zlib.crc32(data)
 
     def _getnode(self, word: str) -> Optional[dict]:
         if len(word) == 0:
@@ -555,52 +573,200 @@ class MarkovFilters(object):
         return smoothed
 
 
-class MarkovTrainer(object):
-    def __init__(self, engine: MarkovTrieDb):
-        self.engine = engine
+class MarkovBigramTable(object):
+    # Bi-gram counts and distances aggregated over a batch of documents, ready to be merged into the model
+    def __init__(self):
+        # Both are kept in the order things were first seen, which is the order the model would have seen them in
+        self.words = {}
+        self.neighbors = {}
 
-    def learn(self, doc: Doc):
-        bi_grams = []
-        for sentence in doc.sents:
-            bi_grams += MarkovTrainer.span_to_bigram(sentence)
+    def __len__(self):
+        return len(self.words)
+
+    @staticmethod
+    def word_key(text: str) -> str:
+        # The same key the trie stores a word under
+        return "".join([c.lower() for c in text])
 
-        row_cache = {}
-        for ngram in bi_grams:
-            if ngram[0].text in row_cache:
-                word = row_cache[ngram[0].text]
+    @staticmethod
+    def merge_neighbors(neighbors: dict, new_neighbors: dict):
+        # Both are in the MarkovWord neighbors format, rows we already have keep their text and features
+        values_idx = NeighborIdx.VALUE_MATRIX.value
+        dist_idx = NeighborIdx.DISTANCE_MATRIX.value
+        count_idx = NeighborValueIdx.COUNT.value
+        for neighbor_key, new_row in new_neighbors.items():
+            row = neighbors.get(neighbor_key)
+            if row is None:
+                neighbors[neighbor_key] = new_row[:values_idx] + [list(new_row[values_idx]), list(new_row[dist_idx])]
             else:
-                # Attempt to load from DB
-                word = self.engine.select(ngram[0].text)
-                if word is None:
-                    # If not already in the DB, create a new word object
-                    word = MarkovWord.from_token(ngram[0])
+                row[values_idx][count_idx] += new_row[values_idx][count_idx]
+                row[dist_idx] = list(map(add, row[dist_idx], new_row[dist_idx]))
 
-            # Handle neighbor
-            neighbor_lookup_key = ngram[1].text.lower()
+    @staticmethod
+    def from_docs(docs: Iterable[ParsedDoc]) -> 'MarkovBigramTable':
+        table = MarkovBigramTable()
+
+        texts = []
+        pos_values = []
+        mode_values = []
+        sentence_lengths = []
+        for doc in docs:
+            doc_pos, doc_modes, doc_sentence_lengths = doc.arrays()
+            texts += [token.text for token in doc]
+            pos_values.append(doc_pos)
+            mode_values.append(doc_modes)
+            sentence_lengths.append(doc_sentence_lengths)
+
+        if len(texts) == 0:
+            return table
+
+        pos_values = np.concatenate(pos_values)
+        compound = np.concatenate(mode_values) == CapitalizationMode.COMPOUND.value
+        sentence_lengths = np.concatenate(sentence_lengths)
+        sentence_ids = np.repeat(np.arange(len(sentence_lengths)), sentence_lengths)
+
+        # Intern every distinct text once, the pairs themselves are only handled as arrays
+        text_ids = {}
+        token_text_ids = np.array([text_ids.setdefault(text, len(text_ids)) for text in texts], dtype=np.int64)
+        word_keys = {}
+        neighbor_keys = {}
+        text_word_ids = []
+        text_neighbor_ids = []
+        for text in text_ids:
+            text_word_ids.append(word_keys.setdefault(MarkovBigramTable.word_key(text), len(word_keys)))
+            text_neighbor_ids.append(neighbor_keys.setdefault(text.lower(), len(neighbor_keys)))
+        word_ids = np.array(text_word_ids, dtype=np.int64)[token_text_ids]
+        neighbor_ids = np.array(text_neighbor_ids, dtype=np.int64)[token_text_ids]
+        word_keys = list(word_keys)
+        neighbor_keys = list(neighbor_keys)
+
+        num_distances = MARKOV_WINDOW_SIZE * 2 + 1
+        positions = np.arange(len(texts), dtype=np.int64)
+        word_positions = []
+        neighbor_positions = []
+        distances = []
+        for dist in range(-MARKOV_WINDOW_SIZE, MARKOV_WINDOW_SIZE + 1):
+            if dist == 0:
+                continue
+            a = positions[max(0, -dist):max(0, len(texts) - max(0, dist))]
+            b = a + dist
+            same_sentence = sentence_ids[a] == sentence_ids[b]
+            word_positions.append(a[same_sentence])
+            neighbor_positions.append(b[same_sentence])
+            distances.append(np.full(np.count_nonzero(same_sentence), dist + MARKOV_WINDOW_SIZE, dtype=np.int64))
+        word_positions = np.concatenate(word_positions)
+        neighbor_positions = np.concatenate(neighbor_positions)
+        distances = np.concatenate(distances)
+
+        if len(word_positions) == 0:
+            return table
+
+        # Sort into the order the pairs appear in the text
+        order = np.argsort(word_positions * num_distances + distances, kind='stable')
+        word_positions = word_positions[order]
+        neighbor_positions = neighbor_positions[order]
+        distances = distances[order]
+
+        pair_keys = word_ids[word_positions] * len(neighbor_keys) + neighbor_ids[neighbor_positions]
+        _, pair_first, pair_inverse = np.unique(pair_keys, return_index=True, return_inverse=True)
+        pair_distances = np.bincount(pair_inverse * num_distances + distances,
+                                     minlength=len(pair_first) * num_distances).reshape(len(pair_first),
+                                                                                        num_distances)
+
+        # Order distinct pairs by when their word was first seen, then by when the pair itself was first seen
+        pair_order = np.argsort(pair_first)
+        pair_word_ids = word_ids[word_positions[pair_first[pair_order]]]
+        _, word_first, word_inverse = np.unique(pair_word_ids, return_index=True, return_inverse=True)
+        pair_order = pair_order[np.argsort(word_first[word_inverse], kind='stable')]
+        first_words = word_positions[pair_first[pair_order]]
+        first_neighbors = neighbor_positions[pair_first[pair_order]]
+        pair_word_ids = word_ids[first_words]
+        word_starts = np.flatnonzero(np.diff(pair_word_ids, prepend=-1))
+        word_ends = np.append(word_starts[1:], len(pair_order))
+
+        # Stored the same way MarkovWord stores its neighbors
+        rows = [[texts[neighbor_position], pos, compound_neighbor, [count, 0], dist]
+                for neighbor_position, pos, compound_neighbor, count, dist in
+                zip(first_neighbors.tolist(), pos_values[first_neighbors].tolist(),
+                    compound[first_neighbors].tolist(), pair_distances[pair_order].sum(axis=1).tolist(),
+                    pair_distances[pair_order].tolist())]
+        row_keys = [neighbor_keys[neighbor_id] for neighbor_id in neighbor_ids[first_neighbors].tolist()]
+
+        for start, end in zip(word_starts.tolist(), word_ends.tolist()):
+            word_position = first_words[start]
+            word_key = word_keys[pair_word_ids[start]]
+            table.words[word_key] = MarkovWord(texts[word_position], Pos(int(pos_values[word_position])),
+                                               bool(compound[word_position]), neighbors={})
+            table.neighbors[word_key] = dict(zip(row_keys[start:end], rows[start:end]))
+
+        return table
 
-            neighbor = word.get_neighbor(neighbor_lookup_key)
-            if neighbor is None:
-                neighbor = MarkovNeighbor.from_token(ngram[1])
 
-            # Increase Count
-            neighbor.values[NeighborValueIdx.COUNT.value] += 1
+class MarkovTrainer(object):
+    def __init__(self, engine: MarkovTrieDb):
+        self.engine = engine
+
+    def learn(self, doc: ParsedDoc):
+        self.learn_batch([doc])
+
+    def learn_batch(self, docs: Iterable[ParsedDoc]):
+        self.merge(MarkovBigramTable.from_docs(docs))
 
-            # Add distance
-            dist_one_hot_base = np.array(neighbor.dist)
-            dist_one_hot_add = np.array(MarkovNeighbor.distance_one_hot(ngram[2]))
+    def learn_parallel(self, batches: Iterable[List[ParsedDoc]], processes: int):
+        from multiprocessing import Pool
 
-            neighbor.dist = (dist_one_hot_base + dist_one_hot_add).tolist()
+        # Batches are merged back in order, which gives exactly the same model as training sequentially
+        with Pool(processes) as pool:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.apply_async(MarkovBigramTable.from_docs, (batch,)))
+                # Only keep a few batches in flight so memory doesn't grow with the corpus
+                if len(pending) >= processes * 2:
+                    self.merge(pending.popleft().get())
+            while len(pending) > 0:
+                self.merge(pending.popleft().get())
 
-            # Convert to db format and store in word
-            key, neighbor_db = neighbor.to_db_format()
-            word.neighbors[key] = neighbor_db
+    def merge(self, table: MarkovBigramTable):
+        for word_key, new_word in table.words.items():
+            # Words and neighbors we already know keep their stored text and features
+            word = self.engine.select(new_word.text)
+            if word is None:
+                word = MarkovWord(new_word.text, new_word.pos, new_word.compound, neighbors={})
+
+            MarkovBigramTable.merge_neighbors(word.neighbors, table.neighbors[word_key])
 
-            # Write word to DB
             if self.engine.update(word) is None:
                 self.engine.insert(word)
 
-            # Cache word
-            row_cache[ngram[0].text] = word
+    @staticmethod
+    def ratings_from_docs(docs: Iterable[ParsedDoc], rating: int = 1) -> dict:
+        # Aggregate the whole batch first so each word is only written once. Keyed the same as MarkovBigramTable
+        ratings = {}
+        for doc in docs:
+            for sentence in doc.sents:
+                for ngram in MarkovTrainer.span_to_bigram(sentence):
+                    word_ratings = ratings.setdefault(MarkovBigramTable.word_key(ngram[0].text), {})
+                    neighbor_key = ngram[1].text.lower()
+                    word_ratings[neighbor_key] = word_ratings.get(neighbor_key, 0) + rating
+        return ratings
+
+    def apply_ratings(self, ratings: dict):
+        # {word key: {neighbor key: rating increment}}
+        for word_key in ratings:
+            # Only rate what we have already learned
+            word = self.engine.select(word_key)
+            if word is None:
+                continue
+
+            for neighbor_key in ratings[word_key]:
+                neighbor = word.get_neighbor(neighbor_key)
+                if neighbor is None:
+                    continue
+
+                neighbor.values[NeighborValueIdx.RATING.value] += ratings[word_key][neighbor_key]
+                word.set_neighbor(neighbor)
+
+            self.engine.update(word)
 
     @staticmethod
     def span_to_bigram(span: Span) -> list:
@@ -618,3 +784,122 @@ class MarkovTrainer(object):
                     grams.append([a, b, dist])
 
         return grams
+
+
+class MarkovLearningPipeline(TrainingDataPipeline):
+    def __init__(self, nlp, data_managers: list, interval: float, batch_size: int, compound_rules: List[str],
+                 sync: Callable[[], None] = None):
+        TrainingDataPipeline.__init__(self, self.__class__.__name__, data_managers, interval, batch_size, sync=sync)
+        self._nlp = nlp
+        self._compound_rules = compound_rules
+
+    def process(self, texts: List[str], row_ids: dict) -> Tuple[MarkovBigramTable, List[int], Optional[dict], dict]:
+        # (Table to merge, sentence counts of the docs, rating increments, last row id learned for each data
+        # manager). Parsing and aggregating happen here, the model only has to merge the table
+        docs = [ParsedDoc.from_doc(doc, self._compound_rules)
+                for doc in self._nlp.pipe([MarkovFilters.filter_input(text) for text in texts])]
+        self._logger.debug("Learned %d messages" % len(texts))
+        return MarkovBigramTable.from_docs(docs), [len(doc.sents) for doc in docs], self.rate(texts, docs), row_ids
+
+    def rate(self, texts: List[str], docs: List[ParsedDoc]) -> Optional[dict]:
+        # Rating increments for MarkovTrainer.apply_ratings, see AOLReactionRatingPipeline
+        return None
+
+
+class MarkovJournal(Thread):
+    # Appends everything merged into the model after it was last saved in full, so it can be persisted while
+    # running without dumping the whole model. Entries are only valid for the saved model they follow
+    CHECKSUM_KEY = 'checksum'
+    LEARNED_KEY = 'learned'
+    RATED_KEY = 'rated'
+
+    def __init__(self, path: str):
+        Thread.__init__(self, name='MarkovJournal', daemon=True)
+        self._path = path
+        self._file = None
+        self._entries = ThreadQueue()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @staticmethod
+    def replay(path: str, model: MarkovTrieDb) -> int:
+        try:
+            lines = open(path, 'r').readlines()
+        except FileNotFoundError:
+            return 0
+        try:
+            header = json.loads(lines[0]) if len(lines) > 0 else None
+        except ValueError:
+            # Torn while starting over, so whatever follows belongs to some other model
+            header = None
+        if not isinstance(header, dict) or header.get(MarkovJournal.CHECKSUM_KEY) != model.checksum:
+            return 0
+
+        trainer = MarkovTrainer(model)
+        replayed = 0
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Cut short by a crash, the rows it came from were never marked trained
+                break
+
+            if MarkovJournal.LEARNED_KEY in entry:
+                table = MarkovBigramTable()
+                for word_key, text, pos, compound, neighbors in entry[MarkovJournal.LEARNED_KEY]:
+                    table.words[word_key] = MarkovWord(text, Pos(pos), compound, neighbors={})
+                    table.neighbors[word_key] = neighbors
+                trainer.merge(table)
+            else:
+                trainer.apply_ratings(entry[MarkovJournal.RATED_KEY])
+            replayed += 1
+        return replayed
+
+    def reset(self, checksum: int):
+        # Start over after the model was saved in full
+        self._entries.put((MarkovJournal.CHECKSUM_KEY, checksum, None))
+
+    def learned(self, table: MarkovBigramTable, row_ids: dict):
+        # Rows are only marked trained once what was learned from them is on disk
+        self._entries.put((MarkovJournal.LEARNED_KEY, table, row_ids))
+
+    def rated(self, ratings: dict):
+        self._entries.put((MarkovJournal.RATED_KEY, ratings, None))
+
+    def flush(self):
+        self._entries.join()
+
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def run(self):
+        while True:
+            key, value, row_ids = self._entries.get()
+            if key is None:
+                self._entries.task_done()
+                break
+
+            if key == MarkovJournal.CHECKSUM_KEY:
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(self._path, 'w')
+                self._write({MarkovJournal.CHECKSUM_KEY: value})
+            elif key == MarkovJournal.LEARNED_KEY:
+                # Tables aren't changed by merging them, so they can be written out while the model moves on
+                self._write({key: [[word_key, word.text, word.pos.value, word.compound, value.neighbors[word_key]]
+                                   for word_key, word in value.words.items()]})
+                for data_manager_type, row_id in row_ids.items():
+                    data_manager = data_manager_type()
+                    data_manager.mark_trained(row_id)
+                    data_manager.close()
+            else:
+                self._write({key: value})
+            self._entries.task_done()
+
+        if self._file is not None:
+            self._file.close()
+
+    def shutdown(self):
+        self._entries.put((None, None, None))
+        self.join()
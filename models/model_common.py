@@ -1,57 +1,209 @@
+import itertools
+import os
+import tempfile
+import threading
+import time
 from enum import unique, Enum
 from multiprocessing import Queue, Process
+from queue import Empty
+
+import numpy as np
+
+
+class MLSharedArray(object):
+    # Arrays at least this large are handed to workers through a memory mapped file instead of the queue
+    MIN_BYTES = 1024 * 1024
+
+    # Prefer a memory backed filesystem when we have one
+    DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def from_array(array: np.ndarray) -> 'MLSharedArray':
+        fd, path = tempfile.mkstemp(prefix='armchair-expert-', suffix='.npy', dir=MLSharedArray.DIRECTORY)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        return MLSharedArray(path)
+
+    def to_array(self) -> np.ndarray:
+        return np.load(self.path, mmap_mode='r')
+
+    def unlink(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def share(data: tuple) -> tuple:
+        shared = []
+        for item in data:
+            if isinstance(item, np.ndarray) and item.nbytes >= MLSharedArray.MIN_BYTES:
+                shared.append(MLSharedArray.from_array(item))
+            else:
+                shared.append(item)
+        return tuple(shared)
+
+    @staticmethod
+    def unshare(data: tuple) -> tuple:
+        if data is None:
+            return None
+        return tuple(item.to_array() if isinstance(item, MLSharedArray) else item for item in data)
+
+    @staticmethod
+    def unlink_all(data: tuple):
+        for item in data:
+            if isinstance(item, MLSharedArray):
+                item.unlink()
+
+
+class MLRequest(object):
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+
+    def resolve(self, result):
+        self._result = result
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+        return self._result
+
+    def resolved(self, timeout: float = None) -> bool:
+        return self._event.wait(timeout=timeout)
 
 
 class MLModelScheduler(object):
+    # Seconds between checks that the worker is still alive while waiting on it
+    WORKER_CHECK_INTERVAL = 1.
+
     def __init__(self):
         self._read_queue = Queue()
         self._write_queue = Queue()
         self._worker = None
 
+        # Results are tagged with a request id so several threads can wait on the same worker
+        self._request_ids = itertools.count()
+        self._requests = {}
+        self._requests_lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+
     def start(self):
         self._worker.start()
+        self._dispatcher.start()
 
     def shutdown(self):
-        self._write_queue.put([MLWorkerCommands.SHUTDOWN, None])
+        self._write_queue.put([MLWorkerCommands.SHUTDOWN, None, None])
+        # Stops the dispatcher as well
+        self._read_queue.put([None, None])
+
+    def _dispatch(self):
+        while True:
+            request_id, result = self._read_queue.get()
+            if request_id is None:
+                return
+            with self._requests_lock:
+                request = self._requests.pop(request_id)
+            request.resolve(result)
+
+    def _request(self, command: 'MLWorkerCommands', data: tuple):
+        request = MLRequest()
+        with self._requests_lock:
+            request_id = next(self._request_ids)
+            self._requests[request_id] = request
+
+        # Only a small descriptor goes through the queue for large arrays
+        data = MLSharedArray.share(data)
+        try:
+            self._write_queue.put([command, request_id, data])
+            # A worker which died would never answer
+            while not request.resolved(timeout=MLModelScheduler.WORKER_CHECK_INTERVAL):
+                if not self._worker.is_alive():
+                    with self._requests_lock:
+                        self._requests.pop(request_id, None)
+                    raise RuntimeError("%s exited with code %s" % (self._worker.name, self._worker.exitcode))
+            return request.wait()
+        finally:
+            MLSharedArray.unlink_all(data)
 
     def _predict(self, *data):
-        self._write_queue.put([MLWorkerCommands.PREDICT, data])
-        return self._read_queue.get()
+        return self._request(MLWorkerCommands.PREDICT, data)
 
     def _train(self, *data):
-        self._write_queue.put([MLWorkerCommands.TRAIN, data])
-        return self._read_queue.get()
+        return self._request(MLWorkerCommands.TRAIN, data)
 
     def _save(self, *data):
-        self._write_queue.put([MLWorkerCommands.SAVE, data])
-        return self._read_queue.get()
+        return self._request(MLWorkerCommands.SAVE, data)
 
     def _load(self, *data):
-        self._write_queue.put([MLWorkerCommands.LOAD, data])
-        return self._read_queue.get()
+        return self._request(MLWorkerCommands.LOAD, data)
 
 
 class MLModelWorker(Process):
-    def __init__(self, name, read_queue: Queue, write_queue: Queue, use_gpu: bool):
+    def __init__(self, name, read_queue: Queue, write_queue: Queue, use_gpu: bool,
+                 predict_batch_window: float = 0., predict_batch_size: int = 1):
         Process.__init__(self, name=name)
         self._read_queue = read_queue
         self._write_queue = write_queue
         self._use_gpu = use_gpu
+        self._predict_batch_window = predict_batch_window
+        self._predict_batch_size = predict_batch_size
         self._model = None
 
+        # Commands which arrived while we were collecting a predict batch
+        self._deferred = []
+
+    def _next_command(self) -> list:
+        if len(self._deferred) > 0:
+            return self._deferred.pop(0)
+        return self._read_queue.get()
+
+    def _collect_predict_batch(self, request_id: int, data) -> list:
+        batch = [(request_id, data)]
+
+        deadline = time.time() + self._predict_batch_window
+        while len(batch) < self._predict_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                command = self._read_queue.get(timeout=timeout)
+            except Empty:
+                break
+
+            if command[0] == MLWorkerCommands.PREDICT:
+                batch.append((command[1], MLSharedArray.unshare(command[2])))
+            else:
+                # Handle anything else after the batch has been served
+                self._deferred.append(command)
+                break
+
+        return batch
+
     def run(self):
         while True:
-            command, data = self._read_queue.get()
+            command, request_id, data = self._next_command()
+            data = MLSharedArray.unshare(data)
             if command == MLWorkerCommands.SHUTDOWN:
                 return
             elif command == MLWorkerCommands.PREDICT:
-                self._write_queue.put(self.predict(data))
+                batch = self._collect_predict_batch(request_id, data)
+                # Results are sent back as soon as each one completes
+                for batch_idx, result in self.predict_batch([batch_data for _, batch_data in batch]):
+                    self._write_queue.put([batch[batch_idx][0], result])
             elif command == MLWorkerCommands.TRAIN:
-                self._write_queue.put(self.train(data))
+                self._write_queue.put([request_id, self.train(data)])
             elif command == MLWorkerCommands.SAVE:
-                self._write_queue.put(self.save(data))
+                self._write_queue.put([request_id, self.save(data)])
             elif command == MLWorkerCommands.LOAD:
-                self._write_queue.put(self.load(data))
+                self._write_queue.put([request_id, self.load(data)])
+
+    def predict_batch(self, batch: list):
+        for data_idx, data in enumerate(batch):
+            yield data_idx, self.predict(data)
 
     def predict(self, *data):
         pass
@@ -72,4 +224,4 @@ class MLWorkerCommands(Enum):
     TRAIN = 1
     PREDICT = 2
     SAVE = 3
-    LOAD = 4
\ No newline at end of file
+    LOAD = 4
@@ -1,14 +1,20 @@
 import re
 from multiprocessing import Queue
+from typing import List, Optional, Callable
 
 import numpy as np
 
+from common.nlp import ParsedDoc
+from markov_engine import MarkovTrainer, MarkovLearningPipeline
 from models.model_common import MLModelScheduler, MLModelWorker
 
 
 class AOLReactionFeatureAnalyzer(object):
     NUM_FEATURES = 8
 
+    FUNNY_EMOJI = ['😂', '😁', '😊', '😁', '😃', '😄', '😹', '🤣']
+    AOL_WORDS = ['lo', 'wtf', 'lmao', 'ha', 'rekt', 'rofl', 'omg']
+
     @staticmethod
     def analyze(text: str) -> list:
         return [
@@ -22,6 +28,99 @@ class AOLReactionFeatureAnalyzer(object):
             AOLReactionFeatureAnalyzer.funny_emoji_ratio(text)
         ]
 
+    @staticmethod
+    def analyze_batch(texts: List[str]) -> np.ndarray:
+        num_texts = len(texts)
+        features = np.zeros((num_texts, AOLReactionFeatureAnalyzer.NUM_FEATURES), dtype=np.float32)
+        if num_texts == 0:
+            return features
+
+        # Work on one flat array of codepoints for the whole batch
+        lengths, text_ids, codepoints, starts = AOLReactionFeatureAnalyzer._codepoints(texts)
+
+        def count(mask: np.ndarray) -> np.ndarray:
+            return np.bincount(text_ids[mask], minlength=num_texts)
+
+        def ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+            return np.divide(numerator, denominator, out=np.zeros(num_texts), where=denominator > 0)
+
+        # Equivalent of len(re.findall(r'[...]+')), runs never continue across two texts
+        text_start = np.zeros(codepoints.size, dtype=bool)
+        text_start[starts[lengths > 0]] = True
+
+        def runs(mask: np.ndarray) -> np.ndarray:
+            previous = np.concatenate(([False], mask[:-1]))
+            return count(mask & (text_start | ~previous))
+
+        is_lower = (codepoints >= ord('a')) & (codepoints <= ord('z'))
+        is_upper = (codepoints >= ord('A')) & (codepoints <= ord('Z'))
+        is_digit = (codepoints >= ord('0')) & (codepoints <= ord('9'))
+
+        # Distinct characters per text
+        keys = np.sort((text_ids.astype(np.int64) << 21) | codepoints)
+        distinct = np.ones(keys.size, dtype=bool)
+        distinct[1:] = keys[1:] != keys[:-1]
+        distinct_count = np.bincount(keys[distinct] >> 21, minlength=num_texts)
+
+        lower_runs = runs(is_lower)
+        upper_runs = runs(is_upper)
+
+        # Adjacent repeated characters within the same text
+        repeated = (codepoints[1:] == codepoints[:-1]) & (text_ids[1:] == text_ids[:-1])
+        repeated_count = np.bincount(text_ids[1:][repeated], minlength=num_texts)
+
+        # Emoji are single codepoints so they can be weighted directly
+        emoji_len = np.zeros(num_texts)
+        for emoji in AOLReactionFeatureAnalyzer.FUNNY_EMOJI:
+            if len(emoji) == 1:
+                emoji_len += count(codepoints == ord(emoji)) * len(emoji)
+            else:
+                emoji_len += np.array([text.count(emoji) * len(emoji) for text in texts])
+
+        features[:, 0] = lengths
+        features[:, 1] = count(codepoints == ord(' '))
+        features[:, 2] = ratio(distinct_count, lengths)
+        features[:, 3] = ratio(upper_runs, lower_runs + upper_runs)
+        features[:, 4] = ratio(runs(is_lower | is_upper | is_digit), lengths)
+        features[:, 5] = AOLReactionFeatureAnalyzer._aol_letter_ratio_batch(texts, text_ids, codepoints)
+        features[:, 6] = ratio(repeated_count, np.maximum(lengths - 1, 0))
+        features[:, 7] = ratio(emoji_len, lengths)
+
+        return features
+
+    @staticmethod
+    def _codepoints(texts: List[str]) -> tuple:
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        text_ids = np.repeat(np.arange(len(texts)), lengths)
+        codepoints = np.frombuffer(''.join(texts).encode('utf-32-le', errors='surrogatepass'), dtype=np.uint32)
+        starts = np.cumsum(lengths) - lengths
+        return lengths, text_ids, codepoints, starts
+
+    @staticmethod
+    def _aol_letter_ratio_batch(texts: List[str], text_ids: np.ndarray, codepoints: np.ndarray) -> np.ndarray:
+        num_texts = len(texts)
+
+        # Lowercasing can change the length of some texts, so it gets its own codepoint array
+        lower_lengths, lower_text_ids, lower_codepoints, _ = AOLReactionFeatureAnalyzer._codepoints(
+            [text.lower() for text in texts])
+
+        present = {}
+        lower_count = {}
+        for c in set(''.join(AOLReactionFeatureAnalyzer.AOL_WORDS)):
+            present[c] = np.bincount(text_ids[codepoints == ord(c)], minlength=num_texts) > 0
+            lower_count[c] = np.bincount(lower_text_ids[lower_codepoints == ord(c)], minlength=num_texts)
+
+        max_ratio = np.zeros(num_texts)
+        for check_letters in AOLReactionFeatureAnalyzer.AOL_WORDS:
+            letters = set(check_letters)
+            found_ratio = np.sum([present[c] for c in letters], axis=0) / len(check_letters)
+            signal_sum = np.sum([lower_count[c] for c in check_letters], axis=0)
+            current_ratio = np.divide(found_ratio * signal_sum, lower_lengths, out=np.zeros(num_texts),
+                                      where=lower_lengths > 0)
+            max_ratio = np.maximum(max_ratio, current_ratio)
+
+        return max_ratio
+
     @staticmethod
     def features() -> list:
         return [
@@ -43,8 +142,7 @@ class AOLReactionFeatureAnalyzer(object):
 
         emoji_len = 0.
 
-        for emoji in ['😂', '😁', '😊', '😁', '😃', '😄',
-                      '😹', '🤣']:
+        for emoji in AOLReactionFeatureAnalyzer.FUNNY_EMOJI:
             emoji_len += line.count(emoji) * len(emoji)
 
         return emoji_len / len(line)
@@ -84,7 +182,7 @@ class AOLReactionFeatureAnalyzer(object):
 
         signal_sum = 0
 
-        for check_letters in ['lo', 'wtf', 'lmao', 'ha', 'rekt', 'rofl', 'omg']:
+        for check_letters in AOLReactionFeatureAnalyzer.AOL_WORDS:
             letters_found = {}
             for c in check_letters:
                 if c in line:
@@ -180,6 +278,10 @@ class AOLReactionModel(object):
         else:
             return False
 
+    def predict_batch(self, features: np.ndarray) -> np.ndarray:
+        predictions = self.model.predict(features, batch_size=len(features))
+        return predictions[:, 0] >= AOLReactionModel.PREDICT_THRESHOLD
+
     def load(self, path):
         self.model.load_weights(path)
 
@@ -197,6 +299,9 @@ class AOLReactionModelWorker(MLModelWorker):
         MLModelWorker.run(self)
 
     def predict(self, *data):
+        # Batches arrive as an already analyzed feature matrix
+        if isinstance(data[0][0], np.ndarray):
+            return self._model.predict_batch(features=data[0][0])
         return self._model.predict(text=data[0][0])
 
     def train(self, *data):
@@ -218,6 +323,9 @@ class AOLReactionModelScheduler(MLModelScheduler):
     def predict(self, text: str):
         return self._predict(text)
 
+    def predict_batch(self, texts: List[str]) -> np.ndarray:
+        return self._predict(AOLReactionFeatureAnalyzer.analyze_batch(texts))
+
     def train(self, data, labels, epochs=1):
         return self._train(data, labels, epochs)
 
@@ -225,4 +333,22 @@ class AOLReactionModelScheduler(MLModelScheduler):
         return self._save(path)
 
     def load(self, path):
-        return self._load(path)
\ No newline at end of file
+        return self._load(path)
+
+
+class AOLReactionRatingPipeline(MarkovLearningPipeline):
+    # Learns new messages and rates the words of those the reaction model finds funny, from the same parse
+    def __init__(self, scheduler: AOLReactionModelScheduler, rating: int, nlp, data_managers: list, interval: float,
+                 batch_size: int, compound_rules: List[str], sync: Callable[[], None] = None):
+        MarkovLearningPipeline.__init__(self, nlp, data_managers, interval, batch_size, compound_rules, sync=sync)
+        self._scheduler = scheduler
+        self._rating = rating
+
+    def rate(self, texts: List[str], docs: List[ParsedDoc]) -> Optional[dict]:
+        # The whole batch is scored in one call
+        predictions = self._scheduler.predict_batch(texts)
+        rated = [doc for doc_idx, doc in enumerate(docs) if predictions[doc_idx]]
+        self._logger.debug("Rated %d of %d messages" % (len(rated), len(texts)))
+        if len(rated) == 0:
+            return None
+        return MarkovTrainer.ratings_from_docs(rated, rating=self._rating)
@@ -1,39 +1,62 @@
+import heapq
+import logging
+import os
 from multiprocessing import Queue
+from threading import Thread
 from typing import List, Tuple
 
 import numpy as np
-from spacy.tokens import Token, Doc
 
 from common.ml import MLDataPreprocessor
-from common.nlp import Pos, CapitalizationMode
-from config.ml import CAPITALIZATION_COMPOUND_RULES, STRUCTURE_MODEL_TRAINING_MAX_SIZE, \
-    STRUCTURE_MODEL_TRAINING_BATCH_SIZE
+from common.nlp import Pos, CapitalizationMode, ParsedDoc
+from config.ml import STRUCTURE_MODEL_TRAINING_MAX_SIZE, \
+    STRUCTURE_MODEL_TRAINING_BATCH_SIZE, STRUCTURE_MODEL_PREDICT_BATCH_WINDOW, STRUCTURE_MODEL_PREDICT_BATCH_SIZE
 from models.model_common import MLModelScheduler, MLModelWorker
 
 
 class StructurePreprocessor(MLDataPreprocessor):
-    def __init__(self):
+    def __init__(self, max_size: int = STRUCTURE_MODEL_TRAINING_MAX_SIZE):
         MLDataPreprocessor.__init__(self, 'StructurePreprocessor')
+        self._max_size = max_size
+        # Weighted reservoir sample (A-Res) of every sequence seen, as a min heap of
+        # (key, sequence number, data, label) so the smallest key is the next to be replaced
+        self._reservoir = []
+        self._sequences = 0
 
     def get_preprocessed_data(self) -> Tuple:
         from keras.preprocessing.sequence import pad_sequences
+        # Back in the order the sequences were seen
+        reservoir = sorted(self._reservoir, key=lambda entry: entry[1])
+        self.data = [data for _, _, data, _ in reservoir]
+        self.labels = [label for _, _, _, label in reservoir]
         structure_data = pad_sequences(self.data, StructureModel.SEQUENCE_LENGTH, padding='post')
         structure_labels = np.array(self.labels)
         return structure_data, structure_labels
 
-    def preprocess(self, doc: Doc) -> bool:
-        if len(self.data) >= STRUCTURE_MODEL_TRAINING_MAX_SIZE:
-            return False
+    def _sample(self, key: float, sequence: list, label: int):
+        # Only sequences which make it into the reservoir are copied
+        if len(self._reservoir) < self._max_size:
+            heapq.heappush(self._reservoir, (key, self._sequences, sequence.copy(), label))
+        elif key > self._reservoir[0][0]:
+            heapq.heapreplace(self._reservoir, (key, self._sequences, sequence.copy(), label))
+        self._sequences += 1
+
+    def preprocess(self, doc: ParsedDoc, weight: float = 1.) -> bool:
+        if weight <= 0:
+            return True
+
+        embeddings = StructureFeatureAnalyzer.analyze_doc(doc).tolist()
+        _, _, sentence_lengths = doc.arrays()
+
+        # One key per sequence, every token and every EOS. log(u) / weight orders the same as u ^ (1 / weight)
+        keys = (np.log(np.random.random_sample(len(embeddings) + len(sentence_lengths))) / weight).tolist()
+        key_idx = 0
 
         sequence = []
         previous_item = None
-        for sentence_idx, sentence in enumerate(doc.sents):
-            if len(self.data) >= STRUCTURE_MODEL_TRAINING_MAX_SIZE:
-                return False
-
-            for token_idx, token in enumerate(sentence):
-                item = StructureFeatureAnalyzer.analyze(
-                    token, CapitalizationMode.from_token(token, CAPITALIZATION_COMPOUND_RULES))
+        token_offset = 0
+        for sentence_length in sentence_lengths.tolist():
+            for item in embeddings[token_offset:token_offset + sentence_length]:
                 label = item
 
                 if len(sequence) == 0:
@@ -45,10 +68,11 @@ class StructurePreprocessor(MLDataPreprocessor):
                 # We only want the latest SEQUENCE_LENGTH items
                 sequence = sequence[-StructureModel.SEQUENCE_LENGTH:]
 
-                self.data.append(sequence.copy())
-                self.labels.append(label)
+                self._sample(keys[key_idx], sequence, label)
+                key_idx += 1
 
                 previous_item = item
+            token_offset += sentence_length
 
             # Handle EOS after each sentence
             item = PoSCapitalizationMode(Pos.EOS, CapitalizationMode.NONE).to_embedding()
@@ -59,8 +83,8 @@ class StructurePreprocessor(MLDataPreprocessor):
             # We only want the latest SEQUENCE_LENGTH items
             sequence = sequence[-StructureModel.SEQUENCE_LENGTH:]
 
-            self.data.append(sequence.copy())
-            self.labels.append(label)
+            self._sample(keys[key_idx], sequence, label)
+            key_idx += 1
 
             previous_item = item
         return True
@@ -88,10 +112,13 @@ class StructureFeatureAnalyzer(object):
     NUM_FEATURES = len(Pos) * len(CapitalizationMode)
 
     @staticmethod
-    def analyze(token: Token, mode: CapitalizationMode):
-        pos = Pos.from_token(token)
-        mode = PoSCapitalizationMode(pos, mode)
-        return mode.to_embedding()
+    def analyze(pos: Pos, mode: CapitalizationMode) -> int:
+        return PoSCapitalizationMode(pos, mode).to_embedding()
+
+    @staticmethod
+    def analyze_doc(doc: ParsedDoc) -> np.ndarray:
+        pos, modes, _ = doc.arrays()
+        return pos * len(CapitalizationMode) + modes
 
 
 class StructureModel(object):
@@ -126,34 +153,51 @@ class StructureModel(object):
         self.model.fit(data, labels, epochs=epochs, batch_size=STRUCTURE_MODEL_TRAINING_BATCH_SIZE)
 
     def predict(self, num_sentences: int) -> List[PoSCapitalizationMode]:
+        for _, modes in self.predict_batch([num_sentences]):
+            return modes
+
+    def predict_batch(self, num_sentences: List[int]):
         from keras.preprocessing.sequence import pad_sequences
 
-        predictions = []
+        predictions = [[] for _ in num_sentences]
 
-        # Start the sequence with NONE / NONE
-        sequence = [[0]]
+        # Start each sequence with NONE / NONE
+        sequences = [[0] for _ in num_sentences]
 
-        eos_count = 0
+        eos_counts = [0] * len(num_sentences)
 
-        while eos_count < num_sentences:
-            padded_sequence = pad_sequences(sequence, maxlen=StructureModel.SEQUENCE_LENGTH, padding='post')
+        active = []
+        for sequence_idx, sequence_sentences in enumerate(num_sentences):
+            if sequence_sentences > 0:
+                active.append(sequence_idx)
+            else:
+                yield sequence_idx, []
 
-            prediction = self.model.predict(padded_sequence, batch_size=1)
-            index = np.random.choice(range(0, StructureFeatureAnalyzer.NUM_FEATURES),
-                                     p=prediction[0])
+        # Advance every unfinished sequence together, one timestep per forward pass
+        while len(active) > 0:
+            padded_sequences = pad_sequences([sequences[sequence_idx] for sequence_idx in active],
+                                             maxlen=StructureModel.SEQUENCE_LENGTH, padding='post')
 
-            if PoSCapitalizationMode.from_embedding(index).pos == Pos.EOS:
-                eos_count += 1
+            prediction = self.model.predict(padded_sequences, batch_size=len(active))
 
-            predictions.append(index)
-            sequence[0].append(index)
-            sequence[0] = sequence[0][-StructureModel.SEQUENCE_LENGTH:]
+            still_active = []
+            for row_idx, sequence_idx in enumerate(active):
+                index = np.random.choice(range(0, StructureFeatureAnalyzer.NUM_FEATURES),
+                                         p=prediction[row_idx])
 
-        modes = []
-        for embedding_idx, embedding in enumerate(predictions):
-            mode = PoSCapitalizationMode.from_embedding(embedding)
-            modes.append(mode)
-        return modes
+                if PoSCapitalizationMode.from_embedding(index).pos == Pos.EOS:
+                    eos_counts[sequence_idx] += 1
+
+                predictions[sequence_idx].append(index)
+                sequences[sequence_idx].append(index)
+                sequences[sequence_idx] = sequences[sequence_idx][-StructureModel.SEQUENCE_LENGTH:]
+
+                if eos_counts[sequence_idx] < num_sentences[sequence_idx]:
+                    still_active.append(sequence_idx)
+                else:
+                    yield sequence_idx, [PoSCapitalizationMode.from_embedding(embedding)
+                                         for embedding in predictions[sequence_idx]]
+            active = still_active
 
     def load(self, path):
         self.model.load_weights(path)
@@ -166,7 +210,9 @@ class StructureModelWorker(MLModelWorker):
     def __init__(self, read_queue: Queue, write_queue: Queue, use_gpu: bool = False):
         MLModelWorker.__init__(self, name='SentenceStructureModelWorker', read_queue=read_queue,
                                write_queue=write_queue,
-                               use_gpu=use_gpu)
+                               use_gpu=use_gpu,
+                               predict_batch_window=STRUCTURE_MODEL_PREDICT_BATCH_WINDOW,
+                               predict_batch_size=STRUCTURE_MODEL_PREDICT_BATCH_SIZE)
 
     def run(self):
         self._model = StructureModel(use_gpu=self._use_gpu)
@@ -175,27 +221,115 @@ class StructureModelWorker(MLModelWorker):
     def predict(self, *data) -> List[PoSCapitalizationMode]:
         return self._model.predict(num_sentences=data[0][0])
 
-    def train(self, *data):
-        return self._model.train(data=data[0][0], labels=data[0][1], epochs=data[0][2])
+    def predict_batch(self, batch: list):
+        return self._model.predict_batch(num_sentences=[data[0] for data in batch])
 
     def save(self, *data):
         return self._model.save(path=data[0][0])
 
     def load(self, *data):
+        # Loading happens between predictions, so a reply never sees half loaded weights
         return self._model.load(path=data[0][0])
 
 
+class StructureModelTrainingWorker(MLModelWorker):
+    def __init__(self, read_queue: Queue, write_queue: Queue, use_gpu: bool = False):
+        MLModelWorker.__init__(self, name='SentenceStructureModelTrainingWorker', read_queue=read_queue,
+                               write_queue=write_queue,
+                               use_gpu=use_gpu)
+
+    def run(self):
+        self._model = StructureModel(use_gpu=self._use_gpu)
+        MLModelWorker.run(self)
+
+    def train(self, *data):
+        data, labels, epochs, path, version = data[0]
+
+        # Continue training from the currently published weights
+        if os.path.exists(path):
+            self._model.load(path)
+
+        self._model.train(data=data, labels=labels, epochs=epochs)
+
+        # Write a versioned file and atomically move it into place once complete
+        versioned_path = "%s.%d" % (path, version)
+        self._model.save(versioned_path)
+        os.replace(versioned_path, path)
+        return path
+
+
+class StructureModelTrainingScheduler(MLModelScheduler):
+    def __init__(self, use_gpu: bool = False):
+        MLModelScheduler.__init__(self)
+        self._worker = StructureModelTrainingWorker(read_queue=self._write_queue, write_queue=self._read_queue,
+                                                    use_gpu=use_gpu)
+
+    def train(self, data, labels, epochs: int, path: str, version: int):
+        return self._train(data, labels, epochs, path, version)
+
+    def terminate(self):
+        self._worker.terminate()
+
+
 class StructureModelScheduler(MLModelScheduler):
     def __init__(self, use_gpu: bool = False):
         MLModelScheduler.__init__(self)
         self._worker = StructureModelWorker(read_queue=self._write_queue, write_queue=self._read_queue,
                                             use_gpu=use_gpu)
+        self._use_gpu = use_gpu
+        self._trainer = None
+        self._training_thread = None
+        self._weights_version = 0
+        self._logger = logging.getLogger(self.__class__.__name__)
 
     def predict(self, num_sentences: int):
         return self._predict(num_sentences)
 
-    def train(self, data, labels, epochs=1):
-        return self._train(data, labels, epochs)
+    def _train_main(self, data, labels, epochs: int, path: str, version: int):
+        self._logger.info("Training weights version %d" % version)
+        try:
+            self._trainer.train(data, labels, epochs, path, version)
+        except Exception:
+            # Keep serving the weights we have
+            self._logger.exception("Training weights version %d failed" % version)
+            return
+        finally:
+            trainer = self._trainer
+            self._trainer = None
+            trainer.shutdown()
+
+        # Hot load the new weights into the inference worker
+        self._load(path)
+        self._logger.info("Loaded weights version %d" % version)
+
+    def train(self, data, labels, path: str, epochs=1, wait: bool = False):
+        if self.training():
+            self.wait_training()
+
+        # Training runs in its own process so predictions are never stuck behind model.fit
+        self._weights_version += 1
+        self._trainer = StructureModelTrainingScheduler(use_gpu=self._use_gpu)
+        self._trainer.start()
+        self._training_thread = Thread(target=self._train_main,
+                                       args=(data, labels, epochs, path, self._weights_version),
+                                       daemon=True)
+        self._training_thread.start()
+
+        if wait:
+            self.wait_training()
+
+    def training(self) -> bool:
+        return self._training_thread is not None and self._training_thread.is_alive()
+
+    def wait_training(self):
+        if self._training_thread is not None:
+            self._training_thread.join()
+
+    def shutdown(self):
+        trainer = self._trainer
+        if trainer is not None:
+            trainer.terminate()
+        MLModelScheduler.shutdown(self)
 
     def save(self, path):
         return self._save(path)
@@ -0,0 +1,103 @@
+import argparse
+import time
+
+from common.nlp import create_nlp_instance, NlpProfile, Pos
+from markov_engine import MarkovFilters
+
+
+def load_texts(datafile: str, limit: int) -> list:
+    if datafile is not None:
+        texts = []
+        for line in open(datafile, 'r', encoding='utf-8', errors='ignore'):
+            if len(texts) >= limit:
+                break
+            texts.append(line.rstrip("\n"))
+    else:
+        from storage.imported import ImportTrainingDataManager
+        rows = ImportTrainingDataManager().all_training_data(limit=limit, order_by='id', order='desc')
+        texts = [row[0].decode() for row in rows]
+
+    return [MarkovFilters.filter_input(text) for text in texts]
+
+
+def legacy_hashtag_pipe(doc):
+    # The previous implementation, which rescans the document after every merge
+    merged_hashtag = False
+    while True:
+        for token_index, token in enumerate(doc):
+            if token.text == '#' and token.whitespace_ == '' and token_index + 1 < len(doc):
+                start_index = token.idx
+                end_index = start_index + len(doc[token_index + 1].text) + 1
+                if doc.merge(start_index, end_index) is not None:
+                    merged_hashtag = True
+                    break
+        if not merged_hashtag:
+            break
+        merged_hashtag = False
+    return doc
+
+
+def benchmark_hashtags(texts: list, batch_size: int):
+    nlp = create_nlp_instance(NlpProfile.TAGGER_PARSER)
+    legacy_nlp = create_nlp_instance(NlpProfile.TAGGER_PARSER)
+    legacy_nlp.replace_pipe('hashtag_pipe', legacy_hashtag_pipe)
+
+    for name, instance in [('legacy', legacy_nlp), ('single pass', nlp)]:
+        start_time = time.time()
+        tokens = 0
+        for doc in instance.pipe(texts, batch_size=batch_size):
+            tokens += len([Pos.from_token(token) for token in doc])
+        elapsed = time.time() - start_time
+        print("Hashtags %s: %f tokens/sec" % (name, tokens / elapsed))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datafile', help='Text file with one message per line, defaults to the imported data')
+    parser.add_argument('--limit', help='Number of messages to parse', type=int, default=10000)
+    parser.add_argument('--batch-size', help='nlp.pipe batch size', type=int, default=1000)
+    parser.add_argument('--hashtags', help='Compare hashtag handling on hashtag dense input', action='store_true')
+    args = parser.parse_args()
+
+    if args.hashtags:
+        texts = [" ".join(["#tag%d" % (tag_idx % 50) for tag_idx in range(msg_idx % 100)]) + " http://example.com @someone"
+                 for msg_idx in range(args.limit)]
+        benchmark_hashtags(texts, args.batch_size)
+        return
+
+    texts = load_texts(args.datafile, args.limit)
+    print("Benchmarking %d messages" % len(texts))
+
+    # Everything is compared against the full pipeline
+    reference = None
+    for profile in NlpProfile:
+        nlp = create_nlp_instance(profile)
+
+        start_time = time.time()
+        docs = list(nlp.pipe(texts, batch_size=args.batch_size))
+        elapsed = time.time() - start_time
+
+        tokens = sum([len(doc) for doc in docs])
+        features = [([Pos.from_token(token) for token in doc], len(list(doc.sents))) for doc in docs]
+        if reference is None:
+            reference = features
+
+        pos_total = 0
+        pos_agree = 0
+        sents_agree = 0
+        for (pos, sents), (reference_pos, reference_sents) in zip(features, reference):
+            # Tokenization doesn't depend on the profile, but don't compare misaligned docs
+            if len(pos) == len(reference_pos):
+                pos_total += len(pos)
+                pos_agree += sum([1 for a, b in zip(pos, reference_pos) if a == b])
+            if sents == reference_sents:
+                sents_agree += 1
+
+        print("%s: %f tokens/sec, PoS agreement: %f%%, Sentence count agreement: %f%%" % (
+            profile.name, tokens / elapsed, pos_agree / max(pos_total, 1) * 100,
+            sents_agree / max(len(docs), 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
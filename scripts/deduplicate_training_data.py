@@ -0,0 +1,32 @@
+from storage.imported import ImportTrainingDataManager
+
+
+def main():
+
+    data_managers = [("Import", ImportTrainingDataManager)]
+    try:
+        from storage.twitter import TwitterTrainingDataManager
+        data_managers.append(("Twitter", TwitterTrainingDataManager))
+    except ImportError:
+        pass
+    try:
+        from storage.discord import DiscordTrainingDataManager
+        data_managers.append(("Discord", DiscordTrainingDataManager))
+    except ImportError:
+        pass
+
+    total_removed = 0
+    for name, data_manager_type in data_managers:
+        data_manager = data_manager_type()
+        print("%s: deduplicating %d rows" % (name, data_manager.count_training_rows()))
+        removed = data_manager.deduplicate()
+        print("%s: removed %d duplicate rows" % (name, removed))
+        total_removed += removed
+
+    print("Removed %d duplicate rows in total" % total_removed)
+    if total_removed > 0:
+        print("Retrain the Markov model (--retrain-markov) to drop the duplicates it has already learned.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 import time
 
 import numpy as np
-from markov_engine import MarkovTrieDb, MarkovGenerator, MarkovFilters
-from config.ml import MARKOV_DB_PATH, STRUCTURE_MODEL_PATH, USE_GPU
+from markov_engine import MarkovTrieDb, MarkovGenerator, MarkovFilters, MarkovJournal
+from config.ml import MARKOV_DB_PATH, MARKOV_JOURNAL_PATH, STRUCTURE_MODEL_PATH, USE_GPU
 from models.structure import StructureModelScheduler
 from common.nlp import CapitalizationMode
 
@@ -11,6 +11,7 @@ def main():
     np.random.seed(int(time.time()))
 
     markov_db = MarkovTrieDb(MARKOV_DB_PATH)
+    MarkovJournal.replay(MARKOV_JOURNAL_PATH, markov_db)
 
     structure_model = StructureModelScheduler(use_gpu=USE_GPU)
     structure_model.start()
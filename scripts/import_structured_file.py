@@ -0,0 +1,97 @@
+import argparse
+import csv
+import datetime
+import json
+import sys
+import time
+from typing import Iterator, Optional, Tuple
+
+from common.importing import open_import_file, parse_timestamp, find_decode_error
+from storage.imported import ImportTrainingDataManager
+
+
+def get_field(record: dict, field: Optional[str]):
+    # Dotted names reach into nested objects, for example author.name
+    if field is None:
+        return None
+    value = record
+    for key in field.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def read_jsonl(datafile) -> Iterator[dict]:
+    for line in datafile:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(record, dict):
+            yield record
+
+
+def read_messages(path: str, file_format: str, text_field: str, timestamp_field: Optional[str],
+                  channel_field: Optional[str], errors: str) -> Iterator[Tuple[str, Optional[datetime.datetime],
+                                                                             Optional[str]]]:
+    with open_import_file(path, errors=errors) as datafile:
+        records = read_jsonl(datafile) if file_format == 'jsonl' else csv.DictReader(datafile)
+        for record in records:
+            text = get_field(record, text_field)
+            if not isinstance(text, str) or len(text.strip()) == 0:
+                continue
+            channel = get_field(record, channel_field)
+            yield text, parse_timestamp(get_field(record, timestamp_field)), \
+                str(channel) if channel is not None and channel != '' else None
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('datafile', help='JSONL or CSV file, optionally gzip compressed (.gz)')
+    parser.add_argument('--format', help='Defaults to the file extension', choices=['jsonl', 'csv'])
+    parser.add_argument('--text-field', help='Field or column containing the message text', default='text')
+    parser.add_argument('--timestamp-field', help='Field or column containing an ISO 8601 or epoch timestamp')
+    parser.add_argument('--channel-field', help='Field or column containing the channel')
+    parser.add_argument('--verbose', help='Print out each message stored for training', action='store_true')
+    parser.add_argument('--batch-size', help='Number of messages inserted and committed at a time', type=int,
+                        default=10000)
+    parser.add_argument('--errors', help='What to do with non UTF-8 characters: refuse to import the file (strict), '
+                                         'or import the messages anyway, replacing or dropping the characters',
+                        choices=['strict', 'replace', 'ignore'], default='strict')
+    args = parser.parse_args()
+
+    file_format = args.format
+    if file_format is None:
+        file_format = 'csv' if args.datafile.replace('.gz', '').endswith('.csv') else 'jsonl'
+
+    if args.errors == 'strict':
+        line = find_decode_error(args.datafile)
+        if line is not None:
+            print("ERROR: Non UTF-8 characters detected on line %d!" % line)
+            print("If the file is not in UTF-8 format, import it with --errors replace or --errors ignore.")
+            print("Terminating, nothing was imported.")
+            sys.exit(1)
+
+    data_manager = ImportTrainingDataManager()
+
+    def messages():
+        for message in read_messages(args.datafile, file_format, args.text_field, args.timestamp_field,
+                                     args.channel_field, args.errors):
+            if args.verbose:
+                print(message[0])
+            yield message
+
+    imported = 0
+    start_time = time.time()
+    for imported in data_manager.store_batches(messages(), args.batch_size):
+        print("Import: %d messages, %f messages/sec" % (imported, imported / (time.time() - start_time)))
+    print("Imported %d messages in %f seconds" % (imported, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
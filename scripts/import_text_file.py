@@ -1,41 +1,49 @@
 import argparse
 import sys
+import time
+from common.importing import open_import_file, find_decode_error
 from storage.imported import ImportTrainingDataManager
 
 
 def main():
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('datafile')
+    parser.add_argument('datafile', help='Text file with one message per line, optionally gzip compressed (.gz)')
     parser.add_argument('--verbose', help='Print out each line of data stored for training',
                         action='store_true')
+    parser.add_argument('--batch-size', help='Number of lines inserted and committed at a time', type=int,
+                        default=10000)
+    parser.add_argument('--errors', help='What to do with non UTF-8 characters: refuse to import the file (strict), '
+                                         'or import the lines anyway, replacing or dropping the characters',
+                        choices=['strict', 'replace', 'ignore'], default='strict')
     args = parser.parse_args()
 
-    try:
-        data = open(args.datafile, 'r').read()
-    except UnicodeDecodeError:
-        print("WARNING: Non UTF-8 characters detected!")
-        print("If the file is not in UTF-8 format, behavior may be completely non functional.")
-        c = input("Continue anyway? (y/n): ")
-        if c != "y":
-            print("Terminating.")
-            sys.exit(0)
-        data = open(args.datafile, 'rb').read()
-        data = data.decode('utf-8', errors='ignore')
+    if args.errors == 'strict':
+        line = find_decode_error(args.datafile)
+        if line is not None:
+            print("ERROR: Non UTF-8 characters detected on line %d!" % line)
+            print("If the file is not in UTF-8 format, import it with --errors replace or --errors ignore.")
+            print("Terminating, nothing was imported.")
+            sys.exit(1)
 
     data_manager = ImportTrainingDataManager()
 
-    lines = data.split("\n")
+    def messages():
+        with open_import_file(args.datafile, errors=args.errors) as datafile:
+            for line in datafile:
+                line = line.rstrip("\r\n")
+                if len(line) == 0:
+                    continue
+                if args.verbose:
+                    print(line)
+                yield line, None, None
 
-    for line_idx, line in enumerate(lines):
-        if line_idx % 1000 == 0:
-            print("Import: %f%%" % (line_idx / len(lines) * 100))
-        if args.verbose:
-            print(line)
-        data_manager.store(line)
-
-    data_manager.commit()
+    imported = 0
+    start_time = time.time()
+    for imported in data_manager.store_batches(messages(), args.batch_size):
+        print("Import: %d lines, %f lines/sec" % (imported, imported / (time.time() - start_time)))
+    print("Imported %d lines in %f seconds" % (imported, time.time() - start_time))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,11 +1,11 @@
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 
+import numpy as np
 from sqlalchemy import Column, Integer
-from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
 
 from config.armchair_expert import STATISTICS_DB_PATH
+from storage.storage_common import SqliteDatabase
 
 Base = declarative_base()
 
@@ -20,14 +20,14 @@ class InputTextStat(Base):
         return "Input Text Length(%d): %d" % (self.length, self.count)
 
 
-engine = create_engine('sqlite:///%s' % STATISTICS_DB_PATH)
-Base.metadata.create_all(engine)
-session_factory = sessionmaker()
-session_factory.configure(bind=engine)
-Session = scoped_session(session_factory)
+database = SqliteDatabase(STATISTICS_DB_PATH, Base.metadata)
+Session = database.session
 
 
 class InputTextStatManager(object):
+    # Process wide (lengths, cumulative counts), rebuilt whenever stats are committed
+    _distribution = None
+
     def __init__(self):
         self._session = Session()
         self._rows = {}
@@ -44,12 +44,33 @@ class InputTextStatManager(object):
             self._rows[length].count += 1
 
     def commit(self):
+        # Built before committing, committed rows would be reloaded one at a time
+        distribution = InputTextStatManager._build_distribution(self._rows.values())
         self._session.commit()
+        InputTextStatManager._distribution = distribution
 
     def reset(self):
         self._session.execute("DELETE FROM inputtextstat")
-        self.commit()
         self._rows = {}
+        self.commit()
+
+    @staticmethod
+    def _build_distribution(rows) -> Tuple[np.ndarray, np.ndarray]:
+        rows = [(row.length, row.count) for row in rows]
+        lengths = np.array([length for length, _ in rows], dtype=np.int64)
+        cdf = np.cumsum([count for _, count in rows], dtype=np.int64)
+        return lengths, cdf
+
+    @staticmethod
+    def sample_length() -> Optional[int]:
+        # Draw a length weighted by how often it was seen, without touching the database after the first call
+        if InputTextStatManager._distribution is None:
+            InputTextStatManager._distribution = InputTextStatManager._build_distribution(
+                Session().query(InputTextStat).all())
+        lengths, cdf = InputTextStatManager._distribution
+        if len(lengths) == 0 or cdf[-1] == 0:
+            return None
+        return int(lengths[np.searchsorted(cdf, np.random.randint(cdf[-1]), side='right')])
 
     def probabilities(self) -> Tuple[List, List]:
 
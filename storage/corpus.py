@@ -0,0 +1,109 @@
+from sqlalchemy import Column, Integer, BLOB, DateTime, String, BigInteger, Index
+from sqlalchemy import func
+from sqlalchemy.ext.declarative import declarative_base
+
+from config.armchair_expert import CORPUS_DB_PATH
+from storage.storage_common import SqliteDatabase, TrainingDataManager
+
+Base = declarative_base()
+
+
+class CorpusMessage(Base):
+    __tablename__ = "corpusmessage"
+    id = Column(Integer, index=True, primary_key=True)
+    source = Column(String, nullable=False)
+    source_row_id = Column(Integer, nullable=False)
+    timestamp = Column(DateTime, nullable=True, index=True)
+    trained = Column(Integer, nullable=False, default=0)
+    text = Column(BLOB, nullable=False)
+    content_hash = Column(BigInteger, nullable=True, index=True, unique=True)
+
+    # Also serves lookups by source alone. Not unique, a source that was recreated reuses its ids
+    __table_args__ = (Index('ix_corpusmessage_source', 'source', 'source_row_id'),)
+
+    def __repr__(self):
+        return self.text.decode()
+
+
+class CorpusSource(Base):
+    # How far each source has been read
+    __tablename__ = "corpussource"
+    source = Column(String, primary_key=True)
+    row_id = Column(Integer, nullable=False)
+    # Of the row at row_id, to notice when the source has changed under us
+    content_hash = Column(BigInteger, nullable=True)
+
+
+def migrate_source_index(engine):
+    # Corpora created before sources could be read again had a unique index
+    for row in engine.execute("PRAGMA index_list(%s)" % CorpusMessage.__tablename__).fetchall():
+        if row[1] == 'ix_corpusmessage_source' and row[2]:
+            engine.execute("DROP INDEX ix_corpusmessage_source")
+            engine.execute("CREATE INDEX ix_corpusmessage_source ON %s (source, source_row_id)"
+                           % CorpusMessage.__tablename__)
+
+
+database = SqliteDatabase(CORPUS_DB_PATH, Base.metadata, [migrate_source_index])
+Session = database.session
+
+
+class CorpusManager(TrainingDataManager):
+    # Source rows are copied this many at a time
+    SYNC_CHUNK_SIZE = 10000
+
+    def __init__(self):
+        TrainingDataManager.__init__(self, CorpusMessage)
+        self._session = Session()
+
+    def _training_rows_columns(self) -> list:
+        # Followed by the source each row came from
+        return TrainingDataManager._training_rows_columns(self) + [CorpusMessage.source]
+
+    def _position(self, source: str) -> 'CorpusSource':
+        position = self._session.query(CorpusSource).filter(CorpusSource.source == source).first()
+        if position is None:
+            # Corpora from before positions were kept only have the copied rows to go by
+            row_id = self._session.query(func.max(CorpusMessage.source_row_id)).filter(
+                CorpusMessage.source == source).scalar()
+            position = CorpusSource(source=source, row_id=row_id if row_id is not None else 0)
+            self._session.add(position)
+        return position
+
+    def sync(self, data_manager: TrainingDataManager) -> int:
+        # Copy whatever the source stored since the last sync. The first sync of a source is the migration
+        # from its own database
+
+        # The watermark has to exist before any rows do, otherwise it is seeded from the rows flagged below
+        self.trained_row_id()
+
+        source = data_manager.source
+        source_trained_row_id = data_manager.trained_row_id()
+        position = self._position(source)
+        if position.content_hash is not None and \
+                data_manager.row_content_hash(position.row_id) != position.content_hash:
+            # The last row we read is gone or different, so the source was recreated or lost rows and its ids
+            # can't be trusted. Read all of it again, messages already in the corpus are skipped by their hash
+            position.row_id = 0
+            position.content_hash = None
+
+        added = 0
+        while True:
+            rows = data_manager.corpus_rows_since(position.row_id, limit=CorpusManager.SYNC_CHUNK_SIZE)
+            if len(rows) == 0:
+                break
+            # Messages already in the corpus, from any source, are skipped
+            result = self._session.execute(CorpusMessage.__table__.insert().prefix_with('OR IGNORE'),
+                                           [{'source': source, 'source_row_id': source_row_id,
+                                             'timestamp': timestamp,
+                                             'trained': int(source_row_id <= source_trained_row_id), 'text': text,
+                                             'content_hash': TrainingDataManager.content_hash(text)}
+                                            for source_row_id, timestamp, text in rows])
+            added += result.rowcount
+
+            # Kept with the rows so a tail of skipped duplicates isn't read again
+            position.row_id = rows[-1][0]
+            position.content_hash = TrainingDataManager.content_hash(rows[-1][2])
+            self._session.commit()
+        # A new or reset position without any rows to go with it
+        self._session.commit()
+        return added
@@ -1,16 +1,23 @@
 import datetime
-from typing import List, Tuple
+import logging
+import time
+from queue import Queue, Empty
+from threading import Thread
+from typing import List
 
 from discord import Message
 
 from sqlalchemy import Column, Integer, DateTime, BigInteger, BLOB
-from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
 
+import config.discord
 from config.discord import DISCORD_TRAINING_DB_PATH
 from common.discord import DiscordHelper
-from storage.storage_common import TrainingDataManager
+from storage.storage_common import SqliteDatabase, TrainingDataManager, migrate_content_hash, migrate_autoincrement
+
+# Configs from before messages were written in batches don't have these, see config/discord.example.py
+DISCORD_STORE_BATCH_SIZE = getattr(config.discord, 'DISCORD_STORE_BATCH_SIZE', 100)
+DISCORD_STORE_FLUSH_INTERVAL = getattr(config.discord, 'DISCORD_STORE_FLUSH_INTERVAL', 5)
 
 Base = declarative_base()
 
@@ -24,16 +31,19 @@ class DiscordMessage(Base):
     timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
     trained = Column(Integer, nullable=False, default=0)
     text = Column(BLOB, nullable=False)
+    content_hash = Column(BigInteger, nullable=True, index=True, unique=True)
+
+    # Ids are never reused, see migrate_autoincrement
+    __table_args__ = {'sqlite_autoincrement': True}
 
     def __repr__(self):
         return self.text.decode()
 
 
-engine = create_engine('sqlite:///%s' % DISCORD_TRAINING_DB_PATH)
-Base.metadata.create_all(engine)
-session_factory = sessionmaker()
-session_factory.configure(bind=engine)
-Session = scoped_session(session_factory)
+database = SqliteDatabase(DISCORD_TRAINING_DB_PATH, Base.metadata, [
+    lambda engine: migrate_content_hash(engine, DiscordMessage.__tablename__),
+    lambda engine: migrate_autoincrement(engine, DiscordMessage.__table__)])
+Session = database.session
 
 
 class DiscordTrainingDataManager(TrainingDataManager):
@@ -41,14 +51,67 @@ class DiscordTrainingDataManager(TrainingDataManager):
         TrainingDataManager.__init__(self, DiscordMessage)
         self._session = Session()
 
+    @staticmethod
+    def message_row(message: Message) -> dict:
+        server_id = int(message.server.id) if message.server is not None else None
+        text = DiscordHelper.filter_content(message).encode()
+        return {'server_id': server_id, 'channel_id': int(message.channel.id), 'user_id': int(message.author.id),
+                'timestamp': message.timestamp, 'trained': 0, 'text': text,
+                'content_hash': TrainingDataManager.content_hash(text)}
+
     def store(self, data: Message):
-        message = data
+        self.store_rows([DiscordTrainingDataManager.message_row(data)])
 
-        filtered_content = DiscordHelper.filter_content(message)
+    def store_rows(self, rows: List[dict]):
+        # Messages we already have are skipped
+        self._session.execute(DiscordMessage.__table__.insert().prefix_with('OR IGNORE'), rows)
 
-        server_id = int(message.server.id) if message.server is not None else None
 
-        message = DiscordMessage(server_id=server_id, channel_id=int(message.channel.id),
-                                 user_id=int(message.author.id), timestamp=message.timestamp,
-                                 text=filtered_content.encode())
-        self._session.add(message)
+class DiscordMessageWriter(Thread):
+    def __init__(self, batch_size: int = DISCORD_STORE_BATCH_SIZE,
+                 flush_interval: float = DISCORD_STORE_FLUSH_INTERVAL):
+        Thread.__init__(self, name='DiscordMessageWriter', daemon=True)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = Queue()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def store(self, message: Message):
+        # Never blocks, the row is written later by our thread
+        self._queue.put(DiscordTrainingDataManager.message_row(message))
+
+    def _flush(self, data_manager: DiscordTrainingDataManager, rows: List[dict]):
+        try:
+            data_manager.store_rows(rows)
+            data_manager.commit()
+            self._logger.debug("Stored %d messages" % len(rows))
+        except Exception:
+            self._logger.exception("Failed to store %d messages" % len(rows))
+            data_manager.rollback()
+
+    def run(self):
+        data_manager = DiscordTrainingDataManager()
+        rows = []
+        deadline = time.time() + self._flush_interval
+        running = True
+        while running:
+            try:
+                row = self._queue.get(timeout=max(0., deadline - time.time()))
+                if row is None:
+                    running = False
+                else:
+                    rows.append(row)
+            except Empty:
+                pass
+
+            if not running or len(rows) >= self._batch_size or time.time() >= deadline:
+                if len(rows) > 0:
+                    self._flush(data_manager, rows)
+                rows = []
+                deadline = time.time() + self._flush_interval
+        data_manager.close()
+
+    def shutdown(self):
+        # Everything queued before this is flushed
+        self._queue.put(None)
+        self.join()
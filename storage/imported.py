@@ -1,12 +1,12 @@
-from typing import List, Tuple
+import datetime
+from typing import List, Tuple, Iterable, Iterator, Optional
 
-from sqlalchemy import Column, Integer, BLOB
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Integer, BLOB, DateTime, String, BigInteger
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
 
 from config.armchair_expert import IMPORT_TRAINING_DB_PATH
-from storage.storage_common import TrainingDataManager
+from storage.storage_common import SqliteDatabase, TrainingDataManager, migrate_columns, migrate_content_hash, \
+    migrate_autoincrement
 
 Base = declarative_base()
 
@@ -16,13 +16,20 @@ class ImportedMessage(Base):
     id = Column(Integer, index=True, primary_key=True)
     trained = Column(Integer, nullable=False, default=0)
     text = Column(BLOB, nullable=False)
+    timestamp = Column(DateTime, nullable=True)
+    channel = Column(String, nullable=True)
+    content_hash = Column(BigInteger, nullable=True, index=True, unique=True)
 
+    # Ids are never reused, see migrate_autoincrement
+    __table_args__ = {'sqlite_autoincrement': True}
 
-engine = create_engine('sqlite:///%s' % IMPORT_TRAINING_DB_PATH)
-Base.metadata.create_all(engine)
-session_factory = sessionmaker()
-session_factory.configure(bind=engine)
-Session = scoped_session(session_factory)
+
+database = SqliteDatabase(IMPORT_TRAINING_DB_PATH, Base.metadata, [
+    lambda engine: migrate_columns(engine, ImportedMessage.__tablename__,
+                                   [('timestamp', 'DATETIME'), ('channel', 'VARCHAR')]),
+    lambda engine: migrate_content_hash(engine, ImportedMessage.__tablename__),
+    lambda engine: migrate_autoincrement(engine, ImportedMessage.__table__)])
+Session = database.session
 
 
 class ImportTrainingDataManager(TrainingDataManager):
@@ -31,6 +38,49 @@ class ImportTrainingDataManager(TrainingDataManager):
         self._session = Session()
 
     def store(self, data: str):
-        message = data
-        imported_message = ImportedMessage(text=message.encode())
-        self._session.add(imported_message)
+        self.store_many([data])
+
+    def store_many(self, data: List[str], timestamps: List[datetime.datetime] = None, channels: List[str] = None):
+        # Bulk insert without creating an ORM object per message
+        if len(data) == 0:
+            return
+        rows = []
+        for message in data:
+            text = message.encode()
+            rows.append({'text': text, 'trained': 0, 'timestamp': None, 'channel': None,
+                         'content_hash': TrainingDataManager.content_hash(text)})
+        for row_idx, row in enumerate(rows):
+            if timestamps is not None:
+                row['timestamp'] = timestamps[row_idx]
+            if channels is not None:
+                row['channel'] = channels[row_idx]
+        # Messages we already have are skipped
+        self._session.execute(ImportedMessage.__table__.insert().prefix_with('OR IGNORE'), rows)
+
+    def store_batches(self, messages: Iterable[Tuple[str, Optional[datetime.datetime], Optional[str]]],
+                      batch_size: int) -> Iterator[int]:
+        # (Text, timestamp, channel) messages, committed batch_size at a time. Yields how many have been committed
+        # so far, the batch being collected when reading the messages fails is rolled back
+        batch = []
+        stored = 0
+        try:
+            for message in messages:
+                batch.append(message)
+                if len(batch) < batch_size:
+                    continue
+                self._store_batch(batch)
+                stored += len(batch)
+                batch = []
+                yield stored
+            if len(batch) > 0:
+                self._store_batch(batch)
+                stored += len(batch)
+                yield stored
+        except BaseException:
+            self.rollback()
+            raise
+
+    def _store_batch(self, batch: List[Tuple[str, Optional[datetime.datetime], Optional[str]]]):
+        self.store_many([text for text, _, _ in batch], timestamps=[timestamp for _, timestamp, _ in batch],
+                        channels=[channel for _, _, channel in batch])
+        self.commit()
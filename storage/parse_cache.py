@@ -0,0 +1,63 @@
+from typing import List, Dict
+
+from sqlalchemy import Column, Integer, String, BLOB
+from sqlalchemy.ext.declarative import declarative_base
+
+from config.armchair_expert import PARSE_CACHE_DB_PATH
+from storage.storage_common import SqliteDatabase
+
+Base = declarative_base()
+
+
+class ParsedDocCacheVersion(Base):
+    __tablename__ = "parseddocversion"
+    id = Column(Integer, index=True, primary_key=True)
+    version = Column(String, nullable=False)
+
+
+class ParsedDocCacheEntry(Base):
+    __tablename__ = "parseddoc"
+    source = Column(String, primary_key=True)
+    row_id = Column(Integer, primary_key=True)
+    data = Column(BLOB, nullable=False)
+
+
+database = SqliteDatabase(PARSE_CACHE_DB_PATH, Base.metadata)
+Session = database.session
+
+
+class ParsedDocCacheManager(object):
+    # SQLite limits the number of variables in a single statement
+    SELECT_CHUNK_SIZE = 500
+
+    def __init__(self, version: str):
+        self._session = Session()
+        self._pending = []
+
+        row = self._session.query(ParsedDocCacheVersion).first()
+        if row is None or row.version != version:
+            # The NLP pipeline changed, so nothing cached is valid anymore
+            self._session.execute("DELETE FROM parseddoc")
+            self._session.execute("DELETE FROM parseddocversion")
+            self._session.add(ParsedDocCacheVersion(version=version))
+            self._session.commit()
+
+    def get(self, source: str, row_ids: List[int]) -> Dict[int, bytes]:
+        cached = {}
+        for chunk_idx in range(0, len(row_ids), ParsedDocCacheManager.SELECT_CHUNK_SIZE):
+            chunk = row_ids[chunk_idx:chunk_idx + ParsedDocCacheManager.SELECT_CHUNK_SIZE]
+            rows = self._session.query(ParsedDocCacheEntry.row_id, ParsedDocCacheEntry.data).filter(
+                ParsedDocCacheEntry.source == source).filter(ParsedDocCacheEntry.row_id.in_(chunk)).all()
+            for row_id, data in rows:
+                cached[row_id] = data
+        return cached
+
+    def add(self, source: str, row_id: int, data: bytes):
+        self._pending.append({'source': source, 'row_id': row_id, 'data': data})
+
+    def commit(self):
+        if len(self._pending) > 0:
+            # Append only, an entry never changes once it has been written
+            self._session.execute(ParsedDocCacheEntry.__table__.insert().prefix_with('OR IGNORE'), self._pending)
+            self._pending = []
+        self._session.commit()
@@ -1,14 +1,185 @@
-from typing import List, Tuple
-from sqlalchemy import desc, asc
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import weakref
+from queue import Queue, Empty
+from typing import List, Tuple, Iterable, Callable, Optional
+from sqlalchemy import desc, asc, func, and_
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
+from sqlalchemy.schema import MetaData, Table
+
+from config.armchair_expert import STORAGE_SQLITE_SYNCHRONOUS, STORAGE_SQLITE_CACHE_SIZE, STORAGE_SQLITE_BUSY_TIMEOUT
+
+
+class SqliteDatabase(object):
+    def __init__(self, path: str, metadata: MetaData, migrations: List[Callable[[Engine], None]] = None):
+        self._path = path
+        self._metadata = metadata
+        self._migrations = migrations if migrations is not None else []
+        self._engine = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._session_factory = sessionmaker()
+
+        # Connector processes are forked after the storage modules are imported. Sessions and pooled connections
+        # are per process, so nothing opened by the parent is ever used by a child
+        self.session = scoped_session(self._create_session, scopefunc=lambda: (os.getpid(), threading.get_ident()))
+
+    @staticmethod
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Readers and writers in other processes don't block each other
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=%s" % STORAGE_SQLITE_SYNCHRONOUS)
+        cursor.execute("PRAGMA cache_size=-%d" % STORAGE_SQLITE_CACHE_SIZE)
+        cursor.close()
+
+    def engine(self) -> Engine:
+        if self._engine is None or self._pid != os.getpid():
+            with self._lock:
+                if self._engine is None or self._pid != os.getpid():
+                    # Every connection to :memory: would be a different database
+                    engine = create_engine('sqlite:///%s' % self._path,
+                                           poolclass=SingletonThreadPool if self._path == ':memory:' else QueuePool,
+                                           connect_args={'check_same_thread': False,
+                                                         'timeout': STORAGE_SQLITE_BUSY_TIMEOUT})
+                    event.listen(engine, 'connect', SqliteDatabase._set_pragmas)
+                    self._metadata.create_all(engine)
+                    for migrate in self._migrations:
+                        migrate(engine)
+                    self._engine = engine
+                    self._pid = os.getpid()
+        return self._engine
+
+    def _create_session(self) -> Session:
+        return self._session_factory(bind=self.engine())
+
+
+def migrate_columns(engine, table_name: str, columns: List[Tuple[str, str]]):
+    # Databases created by older versions don't have these columns yet
+    existing = [row[1] for row in engine.execute("PRAGMA table_info(%s)" % table_name)]
+    for name, column_type in columns:
+        if name not in existing:
+            engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table_name, name, column_type))
+
+
+def migrate_content_hash(engine, table_name: str):
+    migrate_columns(engine, table_name, [('content_hash', 'BIGINT')])
+    # Rows from before hashing have NULL hashes, which the unique index allows until they are deduplicated
+    engine.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_%s_content_hash ON %s (content_hash)" % (table_name,
+                                                                                                 table_name))
+
+
+def migrate_autoincrement(engine, table: Table):
+    # Without AUTOINCREMENT SQLite hands out the ids of deleted rows again, and anything tracking the last id it
+    # read would never see the rows reusing them. Adding it means rebuilding the table
+    row = engine.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name",
+                         {'name': table.name}).first()
+    if row is None or 'AUTOINCREMENT' in row[0].upper():
+        return
+
+    old_name = "%s_migrate" % table.name
+    with engine.begin() as connection:
+        connection.execute("ALTER TABLE %s RENAME TO %s" % (table.name, old_name))
+        # Indexes keep their names when the table is renamed
+        for index_name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND "
+                                              "tbl_name = :name AND sql IS NOT NULL", {'name': old_name}).fetchall():
+            connection.execute("DROP INDEX %s" % index_name)
+        table.create(connection)
+        columns = ", ".join(column.name for column in table.columns)
+        connection.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (table.name, columns, columns, old_name))
+        connection.execute("DROP TABLE %s" % old_name)
 
 
 class TrainingDataManager(object):
+    # Rows are fetched from SQLite this many at a time when streaming training data
+    STREAM_CHUNK_SIZE = 1000
+
+    # Rows are hashed this many at a time when deduplicating
+    DEDUPLICATE_CHUNK_SIZE = 10000
+
+    # Engines of the databases which already have the watermark table. Weak, so an engine created later can't be
+    # mistaken for one which is gone
+    _watermark_tables = weakref.WeakSet()
+
     def __init__(self, table_type):
         self._table_type = table_type
         self._session = None
 
+    @property
+    def source(self) -> str:
+        return self._table_type.__tablename__
+
+    @staticmethod
+    def content_hash(text: bytes) -> int:
+        # Signed so it fits SQLite's 64 bit integers
+        return int.from_bytes(hashlib.blake2b(text, digest_size=8).digest(), 'little', signed=True)
+
+    def deduplicate(self) -> int:
+        # Hash rows stored before hashing existed, oldest first. The oldest copy of a message is the one kept, it is
+        # the one which has been trained on, so newer copies stored since hashing existed make way for it
+        table_name = self._table_type.__tablename__
+        removed = 0
+        row_id = 0
+        while True:
+            rows = self._session.query(self._table_type.id, self._table_type.text).filter(
+                self._table_type.content_hash.is_(None)).filter(self._table_type.id > row_id).order_by(
+                asc(self._table_type.id)).limit(TrainingDataManager.DEDUPLICATE_CHUNK_SIZE).all()
+            if len(rows) == 0:
+                break
+            hashes = [{'id': row_id, 'content_hash': TrainingDataManager.content_hash(text)} for row_id, text in rows]
+            removed += self._session.execute("DELETE FROM %s WHERE content_hash = :content_hash AND id > :id"
+                                             % table_name, hashes).rowcount
+            self._session.execute("UPDATE OR IGNORE %s SET content_hash = :content_hash WHERE id = :id" % table_name,
+                                  hashes)
+            self._session.commit()
+            row_id = rows[-1][0]
+
+        # Anything still without a hash is a copy of an older row
+        removed += self._session.execute("DELETE FROM %s WHERE content_hash IS NULL" % table_name).rowcount
+        self._session.commit()
+        return removed
+
+    def _ensure_watermark_table(self):
+        engine = self._session.get_bind()
+        if engine in TrainingDataManager._watermark_tables:
+            return
+        self._session.execute("CREATE TABLE IF NOT EXISTS trainingwatermark "
+                              "(source VARCHAR PRIMARY KEY, row_id INTEGER NOT NULL)")
+        self._session.commit()
+        TrainingDataManager._watermark_tables.add(engine)
+
+    def trained_row_id(self) -> int:
+        # Every row up to and including this id has been trained on
+        self._ensure_watermark_table()
+        row = self._session.execute("SELECT row_id FROM trainingwatermark WHERE source = :source",
+                                    {'source': self.source}).first()
+        if row is not None:
+            return row[0]
+
+        # Databases from before watermarks only have the trained flags
+        row_id = self._session.query(func.max(self._table_type.id)).filter(self._table_type.trained == 1).scalar()
+        row_id = row_id if row_id is not None else 0
+        self._set_trained_row_id(row_id)
+        return row_id
+
+    def _set_trained_row_id(self, row_id: int):
+        self._ensure_watermark_table()
+        self._session.execute("INSERT OR REPLACE INTO trainingwatermark (source, row_id) VALUES (:source, :row_id)",
+                              {'source': self.source, 'row_id': row_id})
+        self._session.commit()
+
+    def _untrained_clause(self):
+        # Rows flagged trained were trained on before they were copied somewhere new, see CorpusManager
+        return and_(self._table_type.id > self.trained_row_id(), self._table_type.trained == 0)
+
     def new_training_data(self) -> List[Tuple[bytes]]:
-        return self._session.query(self._table_type.text).filter(self._table_type.trained == 0).all()
+        return self._session.query(self._table_type.text).filter(self._untrained_clause()).all()
 
     def all_training_data(self, limit: int = None, order_by: str = None, order='desc') -> List[Tuple[bytes]]:
         query = self._session.query(self._table_type.text)
@@ -20,17 +191,142 @@ class TrainingDataManager(object):
             query = query.limit(limit)
         return query.all()
 
-    def mark_trained(self):
-        self._session.execute('UPDATE ' + self._table_type.__tablename__ + ' SET TRAINED = 1')
-        self._session.commit()
+    def _training_rows_query(self, query, new_only: bool, until: int = None):
+        if new_only:
+            query = query.filter(self._untrained_clause())
+        if until is not None:
+            query = query.filter(self._table_type.id <= until)
+        return query
+
+    def _training_rows_columns(self) -> list:
+        # (id, text, whether the row has been trained on)
+        return [self._table_type.id, self._table_type.text, (~self._untrained_clause()).label('trained')]
+
+    def training_rows(self, new_only: bool = False, order_by: str = None, order='desc',
+                      until: int = None) -> Iterable[Tuple[int, bytes, bool]]:
+        query = self._session.query(*self._training_rows_columns())
+        query = self._training_rows_query(query, new_only, until)
+        # Ties, such as rows without a timestamp, are broken by id
+        if order_by and order == 'desc':
+            query = query.order_by(desc(order_by), desc(self._table_type.id))
+        elif order_by and order == 'asc':
+            query = query.order_by(asc(order_by), asc(self._table_type.id))
+        # Streamed in chunks so the whole table never has to be in memory
+        return query.yield_per(TrainingDataManager.STREAM_CHUNK_SIZE)
+
+    def count_training_rows(self, new_only: bool = False, until: int = None) -> int:
+        query = self._session.query(func.count(self._table_type.id))
+        return self._training_rows_query(query, new_only, until).scalar()
+
+    def corpus_rows_since(self, row_id: int, limit: int = None) -> List[Tuple[int, datetime.datetime, bytes]]:
+        query = self._session.query(self._table_type.id, self._table_type.timestamp, self._table_type.text).filter(
+            self._table_type.id > row_id).order_by(asc(self._table_type.id))
+        if limit:
+            query = query.limit(limit)
+        return query.all()
+
+    def row_content_hash(self, row_id: int) -> Optional[int]:
+        row = self._session.query(self._table_type.text).filter(self._table_type.id == row_id).first()
+        return TrainingDataManager.content_hash(row[0]) if row is not None else None
+
+    def training_data_since(self, row_id: int, limit: int = None) -> List[Tuple[int, bytes]]:
+        # Only rows which haven't been trained on, the same as training_rows(new_only=True)
+        query = self._session.query(self._table_type.id, self._table_type.text).filter(
+            self._table_type.id > row_id).filter(self._untrained_clause()).order_by(asc(self._table_type.id))
+        if limit:
+            query = query.limit(limit)
+        return query.all()
+
+    def latest_row_id(self) -> int:
+        row_id = self._session.query(func.max(self._table_type.id)).scalar()
+        return row_id if row_id is not None else 0
+
+    def mark_trained(self, row_id: int = None):
+        # Rows stored after row_id, for example while training was running, stay untrained
+        row_id = row_id if row_id is not None else self.latest_row_id()
+        if row_id > self.trained_row_id():
+            self._set_trained_row_id(row_id)
 
     def mark_untrained(self):
-        self._session.execute('UPDATE ' + self._table_type.__tablename__ + ' SET TRAINED = 0')
-        self._session.commit()
+        self._session.query(self._table_type).filter(self._table_type.trained == 1).update({'trained': 0})
+        self._set_trained_row_id(0)
 
     def commit(self):
         self._session.commit()
 
+    def rollback(self):
+        self._session.rollback()
+
+    def close(self):
+        self._session.close()
+
     def store(self, data):
         pass
 
+
+class TrainingDataPipeline(threading.Thread):
+    # Polls data managers for rows which haven't been trained on and processes them in batches in our thread.
+    # Whatever process() returns is queued until the main loop picks it up with results()
+    def __init__(self, name: str, data_managers: list, interval: float, batch_size: int,
+                 sync: Callable[[], None] = None):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self._data_managers = data_managers
+        # Brings the data managers up to date before each check for new rows
+        self._sync = sync
+        self._interval = interval
+        self._batch_size = batch_size
+        self._shutdown_event = threading.Event()
+        self._results = Queue()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        # Pick up from whatever hasn't been trained on yet
+        self._watermarks = [data_manager().trained_row_id() for data_manager in self._data_managers]
+
+    def _collect(self) -> Tuple[List[str], dict]:
+        texts = []
+        row_ids = {}
+        for data_manager_idx, data_manager_type in enumerate(self._data_managers):
+            data_manager = data_manager_type()
+            rows = data_manager.training_data_since(self._watermarks[data_manager_idx],
+                                                    limit=self._batch_size - len(texts))
+            data_manager.close()
+            if len(rows) == 0:
+                continue
+            texts += [text.decode() for _, text in rows]
+            self._watermarks[data_manager_idx] = rows[-1][0]
+            row_ids[data_manager_type] = rows[-1][0]
+            if len(texts) >= self._batch_size:
+                break
+        return texts, row_ids
+
+    def process(self, texts: List[str], row_ids: dict):
+        # row_ids is the last row id in texts for each data manager
+        raise NotImplementedError()
+
+    def run(self):
+        while not self._shutdown_event.wait(timeout=self._interval):
+            if self._sync is not None:
+                self._sync()
+            while True:
+                texts, row_ids = self._collect()
+                if len(texts) == 0:
+                    break
+
+                result = self.process(texts, row_ids)
+                if result is not None:
+                    self._results.put(result)
+
+                if len(texts) < self._batch_size:
+                    break
+
+    def results(self) -> list:
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except Empty:
+                return results
+
+    def shutdown(self):
+        self._shutdown_event.set()
+        self.join()
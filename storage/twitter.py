@@ -1,16 +1,14 @@
 import datetime
-from typing import List, Tuple
+from typing import List
 
 import tweepy
 from sqlalchemy import Column, Integer, DateTime, BigInteger, String, BLOB
 from sqlalchemy import func
-from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
 from tweepy import Status
 
 from config.twitter import TWITTER_TRAINING_DB_PATH, TwitterApiCredentials
-from storage.storage_common import TrainingDataManager
+from storage.storage_common import SqliteDatabase, TrainingDataManager, migrate_content_hash, migrate_autoincrement
 
 Base = declarative_base()
 
@@ -33,16 +31,19 @@ class Tweet(Base):
     timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
     trained = Column(Integer, nullable=False, default=0)
     text = Column(BLOB, nullable=False)
+    content_hash = Column(BigInteger, nullable=True, index=True, unique=True)
+
+    # Ids are never reused, see migrate_autoincrement
+    __table_args__ = {'sqlite_autoincrement': True}
 
     def __repr__(self):
         return self.text.decode()
 
 
-engine = create_engine('sqlite:///%s' % TWITTER_TRAINING_DB_PATH)
-Base.metadata.create_all(engine)
-session_factory = sessionmaker()
-session_factory.configure(bind=engine)
-Session = scoped_session(session_factory)
+database = SqliteDatabase(TWITTER_TRAINING_DB_PATH, Base.metadata, [
+    lambda engine: migrate_content_hash(engine, Tweet.__tablename__),
+    lambda engine: migrate_autoincrement(engine, Tweet.__table__)])
+Session = database.session
 
 
 class TwitterTrainingDataManager(TrainingDataManager):
@@ -50,16 +51,24 @@ class TwitterTrainingDataManager(TrainingDataManager):
         TrainingDataManager.__init__(self, Tweet)
         self._session = Session()
 
+    @staticmethod
+    def tweet_row(status: Status) -> dict:
+        text = status.text.encode()
+        return {'status_id': status.id, 'user_id': status.user.id, 'in_reply_to_user_id': status.in_reply_to_user_id,
+                'in_reply_to_status_id': status.in_reply_to_status_id, 'retweeted': int(status.retweeted),
+                'timestamp': status.created_at, 'trained': 0, 'text': text,
+                'content_hash': TrainingDataManager.content_hash(text)}
+
     def store(self, data: Status):
-        status = data
+        self.store_many([data])
+        self._session.commit()
 
-        tweet = self._session.query(Tweet).filter(Tweet.status_id == status.id).first()
-        if tweet is None:
-            tweet = Tweet(status_id=status.id, user_id=status.user.id, in_reply_to_user_id=status.in_reply_to_user_id,
-                          in_reply_to_status_id=status.in_reply_to_status_id, retweeted=int(status.retweeted),
-                          timestamp=status.created_at, text=status.text.encode())
-            self._session.add(tweet)
-            self._session.commit()
+    def store_many(self, data: List[Status]):
+        if len(data) == 0:
+            return
+        # Tweets we already have, by id or by content, are skipped
+        self._session.execute(Tweet.__table__.insert().prefix_with('OR IGNORE'),
+                              [TwitterTrainingDataManager.tweet_row(status) for status in data])
 
 
 class TwitterScraper(object):
@@ -95,29 +104,31 @@ class TwitterScraper(object):
         api = tweepy.API(auth, wait_on_rate_limit=wait_on_rate_limit)
 
         if self.scraper_status.since_id == 0:
-            tweets = tweepy.Cursor(api.user_timeline, screen_name=self.screen_name, count=100,
-                                   lang="en").items()
+            pages = tweepy.Cursor(api.user_timeline, screen_name=self.screen_name, count=100,
+                                  lang="en").pages()
         else:
-            tweets = tweepy.Cursor(api.user_timeline, screen_name=self.screen_name, count=100,
-                                   lang="en", since_id=self.scraper_status.since_id).items()
-
-        for tweet in tweets:
-            tweet_row = self.session.query(Tweet).filter(Tweet.status_id == tweet.id).first()
-            if tweet_row is None:
-                if not tweet.retweeted or (tweet.retweeted and learn_retweets):
-                    tweet_row = Tweet(status_id=tweet.id, user_id=tweet.author.id,
-                                      in_reply_to_status_id=tweet.in_reply_to_status_id,
-                                      in_reply_to_user_id=tweet.in_reply_to_user_id, retweeted=tweet.retweeted,
-                                      timestamp=tweet.created_at, text=tweet.text.encode())
-                    self.session.add(tweet_row)
-
-                # Store the highest ID so we can set it to since_id later
+            pages = tweepy.Cursor(api.user_timeline, screen_name=self.screen_name, count=100,
+                                  lang="en", since_id=self.scraper_status.since_id).pages()
+
+        # Pages run from newest to oldest, so since_id only moves once the last page is in. Otherwise an interrupted
+        # scrape would skip the older tweets it never got to. We look one page ahead to know which page is last.
+        page = next(pages, None)
+        while page is not None:
+            next_page = next(pages, None)
+
+            rows = [TwitterTrainingDataManager.tweet_row(tweet) for tweet in page
+                    if not tweet.retweeted or learn_retweets]
+            if len(rows) > 0:
+                self.session.execute(Tweet.__table__.insert().prefix_with('OR IGNORE'), rows)
+
+            # Store the highest ID so we can set it to since_id later
+            for tweet in page:
                 if self._latest_tweet_processed_id is None or tweet.id > self._latest_tweet_processed_id:
                     self._latest_tweet_processed_id = tweet.id
 
-                # Normally it would be asinine to commit every insert, but we are rate limited by twitter anyway
-                self.session.commit()
+            # Complete scraper progress in the same transaction as the last page
+            if next_page is None:
+                self.scraper_status.since_id = self._latest_tweet_processed_id
+            self.session.commit()
 
-        # Complete scraper progress
-        self.scraper_status.since_id = self._latest_tweet_processed_id
-        self.session.commit()
+            page = next_page
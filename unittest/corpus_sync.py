@@ -0,0 +1,71 @@
+import unittest
+from unittest import mock
+
+import storage.corpus
+import storage.imported
+from storage.corpus import CorpusManager, CorpusMessage
+from storage.imported import ImportTrainingDataManager
+from storage.storage_common import SqliteDatabase
+
+
+class TestCorpusSync(unittest.TestCase):
+    def setUp(self):
+        # Keep the real databases out of this
+        corpus_patcher = mock.patch.object(storage.corpus, 'Session',
+                                           SqliteDatabase(':memory:', storage.corpus.Base.metadata).session)
+        corpus_patcher.start()
+        self.addCleanup(corpus_patcher.stop)
+        self._recreate_import()
+
+    def _recreate_import(self):
+        import_patcher = mock.patch.object(storage.imported, 'Session',
+                                           SqliteDatabase(':memory:', storage.imported.Base.metadata).session)
+        import_patcher.start()
+        self.addCleanup(import_patcher.stop)
+
+    @staticmethod
+    def _import(messages: list):
+        data_manager = ImportTrainingDataManager()
+        data_manager.store_many(messages)
+        data_manager.commit()
+
+    @staticmethod
+    def _sync() -> int:
+        return CorpusManager().sync(ImportTrainingDataManager())
+
+    @staticmethod
+    def _corpus() -> list:
+        return sorted(row[0].decode() for row in storage.corpus.Session().query(CorpusMessage.text))
+
+    def test_sync(self):
+        self._import(["one", "two"])
+        self.assertEqual(self._sync(), 2)
+        self.assertEqual(self._sync(), 0)
+        self._import(["three", "one"])
+        self.assertEqual(self._sync(), 1)
+        self.assertEqual(self._corpus(), ["one", "three", "two"])
+
+    def test_recreated_source(self):
+        self._import(["one", "two", "three"])
+        self._sync()
+
+        # A new database hands out the same ids again
+        self._recreate_import()
+        self._import(["alpha", "beta", "gamma", "delta"])
+        self.assertEqual(self._sync(), 4)
+        self.assertEqual(self._corpus(), ["alpha", "beta", "delta", "gamma", "one", "three", "two"])
+
+    def test_deleted_rows(self):
+        self._import(["one", "two", "three"])
+        self._sync()
+
+        data_manager = ImportTrainingDataManager()
+        data_manager._session.execute("DELETE FROM importedmessage WHERE id = 3")
+        data_manager.commit()
+        self._import(["four"])
+        self.assertEqual(self._sync(), 1)
+        self.assertEqual(self._corpus(), ["four", "one", "three", "two"])
+
+
+if __name__ == '__main__':
+    unittest.main()
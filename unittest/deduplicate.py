@@ -0,0 +1,53 @@
+import unittest
+from unittest import mock
+
+import storage.imported
+from storage.imported import ImportTrainingDataManager, ImportedMessage
+from storage.storage_common import SqliteDatabase
+
+
+class TestDeduplicate(unittest.TestCase):
+    def setUp(self):
+        # Keep the real databases out of this
+        patcher = mock.patch.object(storage.imported, 'Session',
+                                    SqliteDatabase(':memory:', storage.imported.Base.metadata).session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _rows() -> list:
+        return [(row_id, text.decode(), trained) for row_id, text, trained in storage.imported.Session().query(
+            ImportedMessage.id, ImportedMessage.text, ImportedMessage.trained).order_by(ImportedMessage.id)]
+
+    def test_store(self):
+        data_manager = ImportTrainingDataManager()
+        data_manager.store_many(["one", "two", "one"])
+        data_manager.commit()
+        data_manager.store("two")
+        data_manager.store_many(["three"])
+        data_manager.commit()
+        self.assertEqual([text for _, text, _ in self._rows()], ["one", "two", "three"])
+
+    def test_legacy_rows(self):
+        # Stored and trained on before hashing existed
+        data_manager = ImportTrainingDataManager()
+        for text in ["one", "two", "one", "three"]:
+            data_manager._session.execute("INSERT INTO importedmessage (text, trained) VALUES (:text, 1)",
+                                          {'text': text.encode()})
+        data_manager.commit()
+        data_manager.mark_trained()
+
+        # Copies stored since, which have a hash and haven't been trained on
+        data_manager.store_many(["two", "four", "three"])
+        data_manager.commit()
+
+        self.assertEqual(data_manager.deduplicate(), 3)
+        self.assertEqual(self._rows(), [(1, "one", 1), (2, "two", 1), (4, "three", 1), (6, "four", 0)])
+
+        # Only the message which is actually new is left to train on
+        self.assertEqual([text for text, in data_manager.new_training_data()], [b"four"])
+        self.assertEqual(data_manager.deduplicate(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
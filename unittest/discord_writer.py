@@ -0,0 +1,72 @@
+import datetime
+import os
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import storage.discord
+from storage.discord import Base, DiscordMessage, DiscordMessageWriter
+from storage.storage_common import SqliteDatabase
+
+
+class TestDiscordMessageWriter(unittest.TestCase):
+    @staticmethod
+    def _message(text: str) -> SimpleNamespace:
+        return SimpleNamespace(server=None, channel=SimpleNamespace(id='1'), author=SimpleNamespace(id='2'),
+                               timestamp=datetime.datetime(2018, 1, 1), content=text, mentions=[])
+
+    def setUp(self):
+        # The writer has a thread of its own, which would get a database of its own with :memory:
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        database = SqliteDatabase(os.path.join(db_dir.name, 'discord.db'), Base.metadata)
+        database_patcher = mock.patch.object(storage.discord, 'Session', database.session)
+        database_patcher.start()
+        self.addCleanup(database_patcher.stop)
+
+    def _start(self, batch_size: int, flush_interval: float) -> DiscordMessageWriter:
+        writer = DiscordMessageWriter(batch_size=batch_size, flush_interval=flush_interval)
+        writer.start()
+        self.addCleanup(lambda: writer.shutdown() if writer.is_alive() else None)
+        return writer
+
+    @staticmethod
+    def _stored() -> list:
+        session = storage.discord.Session()
+        stored = sorted(row[0].decode() for row in session.query(DiscordMessage.text))
+        storage.discord.Session.remove()
+        return stored
+
+    def _wait_stored(self, count: int, timeout: float = 2.) -> list:
+        deadline = time.time() + timeout
+        while len(self._stored()) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self._stored()
+
+    def test_batch_size(self):
+        writer = self._start(batch_size=2, flush_interval=60)
+        for text in ["one", "two", "three"]:
+            writer.store(self._message(text))
+        self.assertEqual(self._wait_stored(2), ["one", "two"])
+
+        # Not a full batch, so it waits for the interval
+        time.sleep(0.1)
+        self.assertEqual(self._stored(), ["one", "two"])
+
+    def test_flush_interval(self):
+        writer = self._start(batch_size=100, flush_interval=0.1)
+        writer.store(self._message("one"))
+        self.assertEqual(self._wait_stored(1), ["one"])
+
+    def test_shutdown(self):
+        writer = self._start(batch_size=100, flush_interval=60)
+        writer.store(self._message("one"))
+        writer.store(self._message("two"))
+        writer.shutdown()
+        self.assertEqual(self._stored(), ["one", "two"])
+
+
+if __name__ == '__main__':
+    unittest.main()
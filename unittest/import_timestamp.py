@@ -0,0 +1,35 @@
+import datetime
+import unittest
+
+from common.importing import parse_timestamp
+
+
+class TestParseTimestamp(unittest.TestCase):
+    def test_epoch(self):
+        self.assertEqual(parse_timestamp(1514862245), datetime.datetime(2018, 1, 2, 3, 4, 5))
+        self.assertEqual(parse_timestamp('1514862245.5'), datetime.datetime(2018, 1, 2, 3, 4, 5, 500000))
+
+    def test_epoch_milliseconds(self):
+        self.assertEqual(parse_timestamp(1514862245000), datetime.datetime(2018, 1, 2, 3, 4, 5))
+        self.assertEqual(parse_timestamp('1514862245000'), datetime.datetime(2018, 1, 2, 3, 4, 5))
+
+    def test_iso(self):
+        self.assertEqual(parse_timestamp('2018-01-02T03:04:05'), datetime.datetime(2018, 1, 2, 3, 4, 5))
+        self.assertEqual(parse_timestamp('2018-01-02 03:04:05.123Z'), datetime.datetime(2018, 1, 2, 3, 4, 5))
+
+    def test_iso_offset(self):
+        # Stored as UTC, like epoch timestamps
+        self.assertEqual(parse_timestamp('2018-01-02T03:04:05+02:00'), datetime.datetime(2018, 1, 2, 1, 4, 5))
+        self.assertEqual(parse_timestamp('2018-01-02T03:04:05.5-0530'), datetime.datetime(2018, 1, 2, 8, 34, 5))
+        self.assertEqual(parse_timestamp('2018-01-01T23:00:00-02:00'), datetime.datetime(2018, 1, 2, 1, 0, 0))
+
+    def test_date(self):
+        self.assertEqual(parse_timestamp('2018-01-02'), datetime.datetime(2018, 1, 2))
+
+    def test_garbage(self):
+        for value in [None, '', 'yesterday', '2018-13-45', '2018-01-02T25:00:00', '1e20', 'inf', 'nan', {}]:
+            self.assertIsNone(parse_timestamp(value), value)
+
+
+if __name__ == '__main__':
+    unittest.main()
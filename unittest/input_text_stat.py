@@ -0,0 +1,77 @@
+import unittest
+from collections import Counter
+from unittest import mock
+
+import numpy as np
+
+import storage.armchair_expert
+from storage.armchair_expert import InputTextStatManager
+from storage.storage_common import SqliteDatabase
+
+
+class TestInputTextStat(unittest.TestCase):
+    LENGTHS = {3: 5, 1: 2, 10: 1, 7: 4}
+
+    def setUp(self):
+        # Keep the real database out of this
+        patcher = mock.patch.object(storage.armchair_expert, 'Session',
+                                    SqliteDatabase(':memory:', storage.armchair_expert.Base.metadata).session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        distribution_patcher = mock.patch.object(InputTextStatManager, '_distribution', None)
+        distribution_patcher.start()
+        self.addCleanup(distribution_patcher.stop)
+
+    def _store(self, lengths: dict) -> InputTextStatManager:
+        stats = InputTextStatManager()
+        for length, count in lengths.items():
+            for _ in range(count):
+                stats.log_length(length)
+        stats.commit()
+        return stats
+
+    @staticmethod
+    def _sample_all(total: int) -> Counter:
+        # Every draw randint could make, so each length must come up exactly as often as it was stored
+        samples = Counter()
+        for draw in range(total):
+            with mock.patch.object(np.random, 'randint', return_value=draw):
+                samples[InputTextStatManager.sample_length()] += 1
+        return samples
+
+    def test_empty(self):
+        self.assertIsNone(InputTextStatManager.sample_length())
+        self._store({})
+        self.assertIsNone(InputTextStatManager.sample_length())
+
+    def test_distribution(self):
+        self._store(self.LENGTHS)
+        self.assertEqual(self._sample_all(sum(self.LENGTHS.values())), Counter(self.LENGTHS))
+
+    def test_random(self):
+        stats = self._store(self.LENGTHS)
+        choices, p_values = stats.probabilities()
+        np.random.seed(0)
+        samples = Counter(InputTextStatManager.sample_length() for _ in range(20000))
+        self.assertEqual(set(samples.keys()), set(self.LENGTHS.keys()))
+        for length, p in zip(choices, p_values):
+            self.assertAlmostEqual(samples[length] / 20000, p, delta=0.02)
+
+    def test_reload(self):
+        self._store(self.LENGTHS)
+
+        # Loaded from the database when nothing was committed in this process
+        InputTextStatManager._distribution = None
+        self.assertEqual(self._sample_all(sum(self.LENGTHS.values())), Counter(self.LENGTHS))
+
+        # New stats show up as soon as they're committed
+        self._store({1: 3, 20: 2})
+        expected = Counter(self.LENGTHS) + Counter({1: 3, 20: 2})
+        self.assertEqual(self._sample_all(sum(expected.values())), expected)
+
+        InputTextStatManager().reset()
+        self.assertIsNone(InputTextStatManager.sample_length())
+
+
+if __name__ == '__main__':
+    unittest.main()
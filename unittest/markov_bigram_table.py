@@ -0,0 +1,69 @@
+import json
+import unittest
+
+from config.ml import MARKOV_WINDOW_SIZE
+from common.nlp import ParsedDoc, ParsedToken, Pos, CapitalizationMode
+from markov_engine import MarkovBigramTable, MarkovTrainer, MarkovNeighbor, MarkovTrieDb
+
+
+class TestMarkovBigramTable(unittest.TestCase):
+    @staticmethod
+    def _doc(sents: list) -> ParsedDoc:
+        return ParsedDoc([[ParsedToken(text, Pos.HASHTAG if text[0] == '#' else Pos.NOUN,
+                                       CapitalizationMode.COMPOUND if text[0] == '#' else CapitalizationMode.NONE)
+                           for text in sentence.split()] for sentence in sents])
+
+    def test_matches_bigrams(self):
+
+        docs = [self._doc(["The cat sat on the mat", "single", "the THE The cat"]),
+                self._doc(["#tag the cat", "a b c d e f g h i j k"]),
+                self._doc([])]
+
+        expected = {}
+        for doc in docs:
+            for sentence in doc.sents:
+                for word, neighbor, dist in MarkovTrainer.span_to_bigram(sentence):
+                    row = expected.setdefault(MarkovBigramTable.word_key(word.text), {}).setdefault(
+                        neighbor.text.lower(), [neighbor.text, 0, [0] * (MARKOV_WINDOW_SIZE * 2 + 1)])
+                    row[1] += 1
+                    row[2] = [a + b for a, b in zip(row[2], MarkovNeighbor.distance_one_hot(dist))]
+
+        table = MarkovBigramTable.from_docs(docs)
+        self.assertEqual(list(table.words.keys()), list(expected.keys()))
+        self.assertEqual(table.words['the'].text, 'The')
+        for word_key, neighbors in expected.items():
+            self.assertEqual(list(table.neighbors[word_key].keys()), list(neighbors.keys()))
+            for neighbor_key, (text, count, dist) in neighbors.items():
+                row = table.neighbors[word_key][neighbor_key]
+                self.assertEqual(row[0], text)
+                self.assertEqual(row[3], [count, 0])
+                self.assertEqual(row[4], dist)
+
+    def test_parallel_matches_sequential(self):
+
+        docs = [self._doc(["The cat sat on the mat", "the THE The cat %d" % doc_idx]) for doc_idx in range(20)]
+
+        sequential = MarkovTrieDb()
+        MarkovTrainer(sequential).learn_batch(docs)
+        parallel = MarkovTrieDb()
+        MarkovTrainer(parallel).learn_parallel([docs[batch_idx:batch_idx + 3] for batch_idx in range(0, len(docs), 3)],
+                                               processes=2)
+
+        self.assertEqual(json.dumps(parallel._trie), json.dumps(sequential._trie))
+
+    def test_ratings_keys(self):
+        # Final sigma lowercases differently on its own than at the end of a word
+        docs = [self._doc(["ΟΔΟΣ cat"])]
+        table = MarkovBigramTable.from_docs(docs)
+        ratings = MarkovTrainer.ratings_from_docs(docs, rating=2)
+        self.assertEqual(list(ratings.keys()), list(table.words.keys()))
+        for word_key, neighbors in ratings.items():
+            self.assertEqual(list(neighbors.keys()), list(table.neighbors[word_key].keys()))
+
+    def test_empty(self):
+        self.assertEqual(len(MarkovBigramTable.from_docs([])), 0)
+        self.assertEqual(len(MarkovBigramTable.from_docs([self._doc(["one", "two"])])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
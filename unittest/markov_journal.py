@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+import unittest
+
+from common.nlp import ParsedDoc, ParsedToken, Pos, CapitalizationMode
+from markov_engine import MarkovBigramTable, MarkovTrainer, MarkovTrieDb, MarkovJournal
+
+
+class FakeDataManager(object):
+    marked = []
+
+    def mark_trained(self, row_id: int):
+        FakeDataManager.marked.append(row_id)
+
+    def close(self):
+        pass
+
+
+class TestMarkovJournal(unittest.TestCase):
+    @staticmethod
+    def _table(sents: list) -> MarkovBigramTable:
+        return MarkovBigramTable.from_docs([ParsedDoc([[ParsedToken(text, Pos.NOUN, CapitalizationMode.NONE)
+                                                        for text in sentence.split()] for sentence in sents])])
+
+    @staticmethod
+    def _dump(model: MarkovTrieDb) -> str:
+        return json.dumps(model._trie, sort_keys=True)
+
+    def setUp(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        self._model_path = os.path.join(db_dir.name, 'markov.json.zlib')
+        self._journal_path = os.path.join(db_dir.name, 'markov.journal')
+        FakeDataManager.marked = []
+
+        self._model = MarkovTrieDb()
+        MarkovTrainer(self._model).merge(self._table(["the cat sat"]))
+        self._model.save(self._model_path)
+
+        # Merged into the model and the journal, the way the main loop does
+        trainer = MarkovTrainer(self._model)
+        journal = MarkovJournal(self._journal_path)
+        journal.start()
+        journal.reset(self._model.checksum)
+        for sents, row_id in [(["the dog sat", "a cat"], 3), (["the cat ran"], 5)]:
+            table = self._table(sents)
+            trainer.merge(table)
+            journal.learned(table, {FakeDataManager: row_id})
+        ratings = {'the': {'cat': 2}, 'cat': {'ran': 1}}
+        trainer.apply_ratings(ratings)
+        journal.rated(ratings)
+        journal.shutdown()
+
+    def test_replay(self):
+        self.assertEqual(FakeDataManager.marked, [3, 5])
+
+        model = MarkovTrieDb(self._model_path)
+        self.assertEqual(MarkovJournal.replay(self._journal_path, model), 3)
+        self.assertEqual(self._dump(model), self._dump(self._model))
+
+    def test_checksum_mismatch(self):
+        # The model was saved again after the journal was started
+        MarkovTrainer(self._model).merge(self._table(["something else"]))
+        self._model.save(self._model_path)
+
+        model = MarkovTrieDb(self._model_path)
+        self.assertEqual(MarkovJournal.replay(self._journal_path, model), 0)
+        self.assertEqual(self._dump(model), self._dump(self._model))
+
+    def test_truncated(self):
+        lines = open(self._journal_path).readlines()
+        open(self._journal_path, 'w').write("".join(lines[:2]) + lines[2][:len(lines[2]) // 2])
+
+        # Only the first table made it
+        expected = MarkovTrieDb(self._model_path)
+        MarkovTrainer(expected).merge(self._table(["the dog sat", "a cat"]))
+
+        model = MarkovTrieDb(self._model_path)
+        self.assertEqual(MarkovJournal.replay(self._journal_path, model), 1)
+        self.assertEqual(self._dump(model), self._dump(expected))
+
+    def test_torn_header(self):
+        open(self._journal_path, 'w').write('{"checks')
+        model = MarkovTrieDb(self._model_path)
+        self.assertEqual(MarkovJournal.replay(self._journal_path, model), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import storage.parse_cache
+from common.nlp import ParsedDoc, ParsedToken, Pos, CapitalizationMode, nlp_version
+from storage.parse_cache import ParsedDocCacheManager
+from storage.storage_common import SqliteDatabase
+
+
+class TestParseCache(unittest.TestCase):
+    @staticmethod
+    def _doc() -> ParsedDoc:
+        return ParsedDoc([[ParsedToken("Hello", Pos.INTJ, CapitalizationMode.UPPER_FIRST),
+                           ParsedToken("wörld", Pos.NOUN, CapitalizationMode.NONE),
+                           ParsedToken("\"", Pos.PUNCT, CapitalizationMode.NONE)],
+                          [],
+                          [ParsedToken("#RT", Pos.HASHTAG, CapitalizationMode.COMPOUND),
+                           ParsedToken("😀", Pos.EMOJI, CapitalizationMode.NONE)]])
+
+    @staticmethod
+    def _tokens(doc: ParsedDoc) -> list:
+        return [[(token.text, token.pos, token.mode) for token in sentence] for sentence in doc.sents]
+
+    def setUp(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        self._path = os.path.join(db_dir.name, 'parsecache.db')
+        self._restart()
+
+    def _restart(self):
+        patcher = mock.patch.object(storage.parse_cache, 'Session',
+                                    SqliteDatabase(self._path, storage.parse_cache.Base.metadata).session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_roundtrip(self):
+        doc = self._doc()
+        self.assertEqual(self._tokens(ParsedDoc.from_bytes(doc.to_bytes())), self._tokens(doc))
+        self.assertEqual(len(ParsedDoc.from_bytes(ParsedDoc([]).to_bytes()).sents), 0)
+
+    def test_corrupted(self):
+        data = self._doc().to_bytes()
+        for corrupted in [data[:len(data) // 2], b'[[["text", 999, 0]]]', b'[[["text", 0, 999]]]']:
+            with self.assertRaises((ValueError, TypeError)):
+                ParsedDoc.from_bytes(corrupted)
+
+    def test_cache(self):
+        parse_cache = ParsedDocCacheManager('v1')
+        parse_cache.add('corpusmessage', 1, self._doc().to_bytes())
+        parse_cache.add('corpusmessage', 2, ParsedDoc([]).to_bytes())
+        parse_cache.add('other', 1, b'other')
+        parse_cache.commit()
+
+        # Still there for the next start with the same pipeline
+        self._restart()
+        cached = ParsedDocCacheManager('v1').get('corpusmessage', [1, 2, 3])
+        self.assertEqual(sorted(cached.keys()), [1, 2])
+        self.assertEqual(self._tokens(ParsedDoc.from_bytes(cached[1])), self._tokens(self._doc()))
+
+        # Entries are never replaced
+        parse_cache = ParsedDocCacheManager('v1')
+        parse_cache.add('corpusmessage', 1, b'changed')
+        parse_cache.commit()
+        self.assertEqual(parse_cache.get('corpusmessage', [1])[1], self._doc().to_bytes())
+
+    def test_version_change(self):
+        parse_cache = ParsedDocCacheManager('v1')
+        parse_cache.add('corpusmessage', 1, self._doc().to_bytes())
+        parse_cache.commit()
+
+        self._restart()
+        self.assertEqual(ParsedDocCacheManager('v2').get('corpusmessage', [1]), {})
+        self.assertEqual(ParsedDocCacheManager('v1').get('corpusmessage', [1]), {})
+
+    def test_nlp_version(self):
+        nlp = SimpleNamespace(meta={'version': '2.1.0'}, pipe_names=['tagger', 'parser'])
+        version = nlp_version(nlp, ['RT'])
+        self.assertEqual(version, nlp_version(nlp, ['RT']))
+        self.assertNotEqual(version, nlp_version(nlp, ['RT', 'LOL']))
+        self.assertNotEqual(version, nlp_version(SimpleNamespace(meta={'version': '2.1.1'},
+                                                                 pipe_names=['tagger', 'parser']), ['RT']))
+        self.assertNotEqual(version, nlp_version(SimpleNamespace(meta={'version': '2.1.0'},
+                                                                 pipe_names=['tagger']), ['RT']))
+
+
+if __name__ == '__main__':
+    unittest.main()
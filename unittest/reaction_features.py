@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+
+from models.reaction import AOLReactionFeatureAnalyzer
+
+
+class TestAOLReactionFeatureBatch(unittest.TestCase):
+    def test_batch_matches_scalar(self):
+
+        texts = ['',
+                 'a',
+                 'lol',
+                 'LMAO wtf is this',
+                 'hahahahaha 😂😂😂',
+                 'ROFL!!!   rekt 🤣😁',
+                 'omg OMG oMg',
+                 'aaaaaa bbbb   ',
+                 'Straße ΣΑΣ K İstanbul ok',
+                 'http://example.com/some_path?x=1 lol',
+                 '#hashtag @someone 123abc',
+                 '\n\n\t']
+
+        batch = AOLReactionFeatureAnalyzer.analyze_batch(texts)
+
+        self.assertEqual(batch.shape, (len(texts), AOLReactionFeatureAnalyzer.NUM_FEATURES))
+        self.assertEqual(batch.dtype, np.float32)
+
+        for text_idx, text in enumerate(texts):
+            expected = np.array(AOLReactionFeatureAnalyzer.analyze(text), dtype=np.float32)
+            np.testing.assert_allclose(batch[text_idx], expected, rtol=1e-6, err_msg=text)
+
+    def test_empty_batch(self):
+        batch = AOLReactionFeatureAnalyzer.analyze_batch([])
+        self.assertEqual(batch.shape, (0, AOLReactionFeatureAnalyzer.NUM_FEATURES))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from models.model_common import MLSharedArray, MLModelScheduler, MLModelWorker
+
+
+class SharedArrayWorker(MLModelWorker):
+    def train(self, data):
+        array = data[0]
+        return isinstance(array, np.memmap), sorted(os.listdir(os.path.dirname(array.filename))), float(array.sum())
+
+    def predict(self, data):
+        array = data[0]
+        return isinstance(array, np.memmap), float(array.sum())
+
+
+class SharedArrayScheduler(MLModelScheduler):
+    def __init__(self):
+        MLModelScheduler.__init__(self)
+        self._worker = SharedArrayWorker(name='SharedArrayWorker', read_queue=self._write_queue,
+                                         write_queue=self._read_queue, use_gpu=False)
+
+    def train(self, array: np.ndarray):
+        return self._train(array)
+
+    def predict(self, array: np.ndarray):
+        return self._predict(array)
+
+
+class TestSharedArray(unittest.TestCase):
+    def setUp(self):
+        shm_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(shm_dir.cleanup)
+        self._dir = shm_dir.name
+        patcher = mock.patch.object(MLSharedArray, 'DIRECTORY', self._dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_share(self):
+        large = np.arange(MLSharedArray.MIN_BYTES // 8, dtype=np.float64)
+        small = np.arange(16, dtype=np.float64)
+
+        shared = MLSharedArray.share((large, small, 'text'))
+        self.assertIsInstance(shared[0], MLSharedArray)
+        self.assertIs(shared[1], small)
+        self.assertEqual(shared[2], 'text')
+        self.assertEqual(os.path.dirname(shared[0].path), self._dir)
+        self.assertTrue(os.path.basename(shared[0].path).startswith('armchair-expert-'))
+
+        unshared = MLSharedArray.unshare(shared)
+        self.assertIsInstance(unshared[0], np.memmap)
+        self.assertEqual(unshared[0].dtype, large.dtype)
+        np.testing.assert_array_equal(unshared[0], large)
+        self.assertIs(unshared[1], small)
+        self.assertIsNone(MLSharedArray.unshare(None))
+        del unshared
+
+        MLSharedArray.unlink_all(shared)
+        self.assertEqual(os.listdir(self._dir), [])
+        # Unlinking twice is harmless
+        MLSharedArray.unlink_all(shared)
+
+    def test_worker(self):
+        scheduler = SharedArrayScheduler()
+        scheduler.start()
+        try:
+            large = np.ones((MLSharedArray.MIN_BYTES // 8 // 4, 4), dtype=np.float64)
+            memmap, files, total = scheduler.train(large)
+            self.assertTrue(memmap)
+            self.assertEqual(len(files), 1)
+            self.assertEqual(total, large.sum())
+
+            self.assertEqual(scheduler.predict(np.ones(4)), (False, 4.))
+            self.assertEqual(os.listdir(self._dir), [])
+        finally:
+            scheduler.shutdown()
+            scheduler._worker.join()
+
+        # Cleaned up even though the worker is gone
+        with self.assertRaises(RuntimeError):
+            scheduler.train(large)
+        self.assertEqual(os.listdir(self._dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
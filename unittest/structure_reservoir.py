@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+
+from common.nlp import ParsedDoc, ParsedToken, Pos, CapitalizationMode
+from models.structure import StructurePreprocessor, PoSCapitalizationMode
+
+
+class TestStructureReservoir(unittest.TestCase):
+    @staticmethod
+    def _doc(pos: Pos, length: int) -> ParsedDoc:
+        return ParsedDoc([[ParsedToken('word', pos, CapitalizationMode.NONE) for _ in range(length)]])
+
+    @staticmethod
+    def _count(labels: np.ndarray, pos: Pos) -> int:
+        return int(np.sum(labels == PoSCapitalizationMode(pos, CapitalizationMode.NONE).to_embedding()))
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_capacity(self):
+        preprocessor = StructurePreprocessor(max_size=50)
+        for _ in range(20):
+            preprocessor.preprocess(self._doc(Pos.NOUN, 9))
+
+        data, labels = preprocessor.get_preprocessed_data()
+        self.assertEqual(len(data), 50)
+        self.assertEqual(len(labels), 50)
+
+    def test_keeps_everything_below_capacity(self):
+        preprocessor = StructurePreprocessor(max_size=1000)
+        preprocessor.preprocess(self._doc(Pos.NOUN, 3))
+        preprocessor.preprocess(self._doc(Pos.VERB, 2))
+
+        # Every token and an EOS per sentence, in the order they were seen
+        _, labels = preprocessor.get_preprocessed_data()
+        self.assertEqual(labels.tolist(), [PoSCapitalizationMode(pos, CapitalizationMode.NONE).to_embedding()
+                                           for pos in [Pos.NOUN] * 3 + [Pos.EOS] + [Pos.VERB] * 2 + [Pos.EOS]])
+
+    def test_weights(self):
+        preprocessor = StructurePreprocessor(max_size=1000)
+        for _ in range(500):
+            preprocessor.preprocess(self._doc(Pos.NOUN, 9), weight=4.)
+            preprocessor.preprocess(self._doc(Pos.VERB, 9), weight=1.)
+            preprocessor.preprocess(self._doc(Pos.ADJ, 9), weight=0.)
+
+        _, labels = preprocessor.get_preprocessed_data()
+        self.assertGreater(self._count(labels, Pos.NOUN), self._count(labels, Pos.VERB) * 2)
+        self.assertGreater(self._count(labels, Pos.VERB), 0)
+        self.assertEqual(self._count(labels, Pos.ADJ), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import storage.imported
+from storage.imported import ImportTrainingDataManager
+from storage.storage_common import SqliteDatabase
+
+
+class TestTrainingWatermark(unittest.TestCase):
+    def setUp(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        self._path = os.path.join(db_dir.name, 'import.db')
+        self._restart()
+
+    def _restart(self):
+        # A new engine on the same file, like the next start of the bot
+        patcher = mock.patch.object(storage.imported, 'Session',
+                                    SqliteDatabase(self._path, storage.imported.Base.metadata).session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _import(messages: list):
+        data_manager = ImportTrainingDataManager()
+        data_manager.store_many(messages)
+        data_manager.commit()
+
+    @staticmethod
+    def _texts(rows) -> list:
+        return [row[1].decode() for row in rows]
+
+    def test_window(self):
+        self._import(["one", "two", "three"])
+        data_manager = ImportTrainingDataManager()
+        self.assertEqual(data_manager.trained_row_id(), 0)
+        self.assertEqual(data_manager.latest_row_id(), 3)
+
+        # Training only covers what was stored when it began
+        until = data_manager.latest_row_id()
+        self._import(["four"])
+        self.assertEqual(data_manager.count_training_rows(new_only=True, until=until), 3)
+        self.assertEqual(self._texts(data_manager.training_rows(new_only=True, order_by='id', order='asc',
+                                                                until=until)), ["one", "two", "three"])
+        data_manager.mark_trained(until)
+
+        self.assertEqual(data_manager.count_training_rows(new_only=True), 1)
+        self.assertEqual(data_manager.count_training_rows(), 4)
+        self.assertEqual(self._texts(data_manager.training_data_since(0)), ["four"])
+        self.assertEqual([trained for _, _, trained in data_manager.training_rows(order_by='id', order='asc')],
+                         [True, True, True, False])
+
+        # Never moves backwards
+        data_manager.mark_trained(1)
+        self.assertEqual(data_manager.trained_row_id(), 3)
+
+    def test_restart(self):
+        self._import(["one", "two"])
+        ImportTrainingDataManager().mark_trained()
+        self._import(["three"])
+
+        self._restart()
+        data_manager = ImportTrainingDataManager()
+        self.assertEqual(data_manager.trained_row_id(), 2)
+        self.assertEqual(self._texts(data_manager.training_rows(new_only=True)), ["three"])
+
+    def test_mark_untrained(self):
+        self._import(["one", "two"])
+        data_manager = ImportTrainingDataManager()
+        data_manager.mark_trained()
+        data_manager.mark_untrained()
+
+        self._restart()
+        data_manager = ImportTrainingDataManager()
+        self.assertEqual(data_manager.trained_row_id(), 0)
+        self.assertEqual(data_manager.count_training_rows(new_only=True), 2)
+
+    def test_trained_flags(self):
+        # Databases from before the watermark only have the trained flags
+        self._import(["one", "two", "three"])
+        data_manager = ImportTrainingDataManager()
+        data_manager._session.execute("UPDATE importedmessage SET trained = 1 WHERE id <= 2")
+        data_manager.commit()
+
+        self.assertEqual(data_manager.trained_row_id(), 2)
+        self.assertEqual(self._texts(data_manager.training_rows(new_only=True)), ["three"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import datetime
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import storage.twitter
+from config.twitter import TwitterApiCredentials
+from storage.storage_common import SqliteDatabase
+from storage.twitter import Base, Tweet, ScraperStatus, TwitterScraper, TwitterTrainingDataManager
+
+
+class FakeCursor(object):
+    # Stands in for tweepy.Cursor, serving canned pages of statuses from newest to oldest
+    pages_served = []
+    calls = []
+
+    def __init__(self, method, **kwargs):
+        FakeCursor.calls.append(kwargs)
+        self._since_id = kwargs.get('since_id', 0)
+
+    def pages(self):
+        for page in FakeCursor.pages_served:
+            if isinstance(page, Exception):
+                raise page
+            page = [status for status in page if status.id > self._since_id]
+            if len(page) > 0:
+                yield page
+
+
+class TestTwitterScraper(unittest.TestCase):
+    @staticmethod
+    def _status(status_id: int, text: str, retweeted: bool = False) -> SimpleNamespace:
+        return SimpleNamespace(id=status_id, user=SimpleNamespace(id=1), text=text, in_reply_to_user_id=None,
+                               in_reply_to_status_id=None, retweeted=retweeted,
+                               created_at=datetime.datetime(2018, 1, 1))
+
+    def setUp(self):
+        # Keep the real training database out of this
+        database = SqliteDatabase(':memory:', Base.metadata)
+        database_patcher = mock.patch.object(storage.twitter, 'Session', database.session)
+        database_patcher.start()
+        self.addCleanup(database_patcher.stop)
+
+        FakeCursor.pages_served = []
+        FakeCursor.calls = []
+        patcher = mock.patch.multiple(storage.twitter.tweepy, Cursor=FakeCursor, API=mock.DEFAULT,
+                                      OAuthHandler=mock.DEFAULT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _scrape(self, learn_retweets: bool = False):
+        scraper = TwitterScraper(TwitterApiCredentials('', '', '', ''), 'someone')
+        scraper.scrape(learn_retweets=learn_retweets)
+        storage.twitter.Session.remove()
+
+    def test_scrape_pages(self):
+        FakeCursor.pages_served = [[self._status(30, "newest"), self._status(29, "retweet", retweeted=True)],
+                                   [self._status(20, "older"), self._status(19, "newest")]]
+        self._scrape()
+
+        session = storage.twitter.Session()
+        self.assertEqual(sorted(tweet.status_id for tweet in session.query(Tweet)), [20, 30])
+        self.assertEqual(session.query(ScraperStatus).one().since_id, 30)
+        storage.twitter.Session.remove()
+
+        # The next scrape only asks for newer tweets
+        FakeCursor.pages_served = [[self._status(40, "even newer")]] + FakeCursor.pages_served
+        self._scrape()
+
+        session = storage.twitter.Session()
+        self.assertEqual(FakeCursor.calls[-1]['since_id'], 30)
+        self.assertEqual(sorted(tweet.status_id for tweet in session.query(Tweet)), [20, 30, 40])
+        self.assertEqual(session.query(ScraperStatus).one().since_id, 40)
+
+    def test_interrupted_scrape(self):
+        FakeCursor.pages_served = [[self._status(30, "newest")], RuntimeError("rate limited")]
+        with self.assertRaises(RuntimeError):
+            self._scrape()
+        storage.twitter.Session.remove()
+
+        # Older pages are still missing, so since_id must not have moved past them
+        self.assertEqual(storage.twitter.Session().query(ScraperStatus).one().since_id, 0)
+
+    def test_store(self):
+        data_manager = TwitterTrainingDataManager()
+        data_manager.store(self._status(1, "hello"))
+        data_manager.store_many([self._status(1, "hello"), self._status(2, "hello"), self._status(3, "world")])
+        data_manager.commit()
+        self.assertEqual(sorted(tweet.status_id for tweet in storage.twitter.Session().query(Tweet)), [1, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()